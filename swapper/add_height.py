@@ -1,15 +1,42 @@
 import cv2
 import numpy as np
+from typing import Optional, Tuple
+
+
+def pad_height(image: np.ndarray, ratio: float = 0.1) -> Tuple[np.ndarray, int]:
+    """Adds white rows (ratio of the height) below the image, in memory.
+
+    Returns the padded image and the original height, remove_height_padding
+    crops a result of the same size back exactly.
+    """
+    height, width = image.shape[:2]
+    padded = np.full((int(height * (1 + ratio)), width) + image.shape[2:], 255, dtype=np.uint8)
+    padded[:height] = image
+    return padded, height
+
+
+def remove_height_padding(image: np.ndarray, height: int, padded_height: int) -> np.ndarray:
+    # The result may be resized relative to the padded input, the crop is scaled the same way
+    if image.shape[0] != padded_height:
+        height = int(round(height * image.shape[0] / padded_height))
+    return image[:height]
+
+
+def trim_white_bottom(image: np.ndarray, reference: Optional[np.ndarray] = None) -> np.ndarray:
+    # Removes the white (255) rows at the bottom, the image as is if it's white entirely.
+    # The rows are checked on 'reference' (e.g. a grayscale copy), on the image by default
+    reference = image if reference is None else reference
+    non_white_rows = np.flatnonzero(np.any(reference.reshape(reference.shape[0], -1) != 255, axis=1))
+    if non_white_rows.shape[0] == 0:
+        return image
+    return image[: non_white_rows[-1] + 1]
 
 
 def height_increaser(image_path:str):
     try:
         image = cv2.imread(image_path)
-        height, width, _ = image.shape
-        new_height = int(height * 1.1)
-        print(f"prev_height: {height},\nnew_height: {new_height}")  
-        white_image = np.ones((new_height, width, 3), dtype=np.uint8) * 255
-        white_image[0:height, 0:width] = image
+        white_image, height = pad_height(image)
+        print(f"prev_height: {height},\nnew_height: {white_image.shape[0]}")
         cv2.imwrite(image_path, white_image)
         return True
     except Exception as e:
@@ -20,42 +47,19 @@ def height_increaser(image_path:str):
 def height_decrease(image_path: str) -> bool:
     """
     Reads an image, detects and removes any white space from the bottom.
-    This approach scans rows from the bottom up until it finds a row that
-    is not completely white. Everything below that row is removed.
+    Everything below the last row that is not completely white is removed.
     """
     try:
         image = cv2.imread(image_path)
         if image is None:
             raise ValueError("Image not found or unable to read.")
         
-        # Convert to grayscale for easier checks
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        height, width = gray.shape
-        
-        # We scan from the bottom row upwards to find the first row
-        # that is NOT all white. We'll store its index.
-        last_non_white_row = 0
-        for row in range(height - 1, -1, -1):
-            # Check if the entire row is white (all 255)
-            # If you want to allow some tolerance (e.g., near-white),
-            # you can use a threshold condition instead, like:
-            # if not np.all(gray[row] > 250):
-            if not np.all(gray[row] == 255):
-                last_non_white_row = row
-                break
-        
-        # If last_non_white_row remains 0 and that row is also all white,
-        # it implies the entire image is white. You can handle that case
-        # however you wish. For now, we'll just keep it as is.
-        if last_non_white_row == 0 and np.all(gray[0] == 255):
-            # Entire image is white or nearly white
+        cropped_image = trim_white_bottom(image, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+        if cropped_image is image:
+            # Entire image is white
             print("Warning: Entire image appears to be white.")
-            # Optionally do nothing or skip cropping.
             return True
-        
-        # Crop the image from row 0 to last_non_white_row
-        cropped_image = image[:last_non_white_row + 1, :]
-        
+
         # Overwrite the original image with the cropped version
         cv2.imwrite(image_path, cropped_image)
         
@@ -9,33 +9,110 @@ import numpy as np
 from src.simswap import SimSwap
 from src.DataManager.ImageDataManager import ImageDataManager
 from src.DataManager.VideoDataManager import VideoDataManager
-from src.DataManager.utils import imread_rgb
+from src.DataManager.utils import imread_rgb, load_multispecific_gallery
+from src.Runner.bulk import BulkImageJob
+from src.Runner.pipeline import PipelinedRunner
+from src.Runner.segments import SegmentedVideoJob
 
 
 def run_application(config: DictConfig):
     try:
-        id_image_path = Path(config.id_image)
-        att_image_path = Path(config.att_image)
-        output_dir = Path(config.output_dir)
+        data, pipeline = config.data, config.pipeline
+        id_image_path = Path(data.id_image)
+        att_image_path = Path(data.att_image)
+        output_dir = Path(data.output_dir)
         assert id_image_path.exists(), f"Can't find {id_image_path} file!"
         id_image: Optional[np.ndarray] = imread_rgb(id_image_path)
+        multispecific_dir = data.multispecific_dir
+        multispecific_gallery = None
+        if multispecific_dir and multispecific_dir != "none":
+            multispecific_gallery = load_multispecific_gallery(multispecific_dir)
+        # Before any data manager is created, the bulk job reads the images itself
+        bulk_manifest = data.bulk_manifest
+        if bulk_manifest and bulk_manifest != "none":
+            num_failed = BulkImageJob(
+                config,
+                manifest_path=Path(bulk_manifest),
+                output_dir=output_dir,
+                id_image=id_image,
+                multispecific_gallery=multispecific_gallery,
+                shard_index=data.bulk_shard_index,
+                num_shards=data.bulk_num_shards,
+                num_workers=data.bulk_workers,
+            ).run()
+            assert num_failed == 0, f"{num_failed} images failed, see the status log in {output_dir}"
+            return True
         att_image: Optional[ImageDataManager] = None
+        # Inputs are decoded at the capped size unless the faces go back into the full resolution
+        decode_megapixels = pipeline.max_megapixels
+        if pipeline.restore_full_resolution:
+            decode_megapixels = 0
         if att_image_path and (att_image_path.is_file() or att_image_path.is_dir()):
             att_image: Optional[ImageDataManager] = ImageDataManager(
-                src_data=att_image_path, output_dir=output_dir
+                src_data=att_image_path,
+                output_dir=output_dir,
+                read_ahead=data.image_read_ahead,
+                write_workers=data.image_write_workers,
+                max_megapixels=decode_megapixels,
             )
         att_video: Optional[VideoDataManager] = None
+        att_video_path = Path(data.att_video)
+        segment_workers = data.segment_workers
+        if att_video_path.is_file() and segment_workers > 0:
+            assert not att_image, "Only one attribute source can be used!"
+            SegmentedVideoJob(
+                config,
+                src_video=att_video_path,
+                output_dir=output_dir,
+                id_image=id_image,
+                multispecific_gallery=multispecific_gallery,
+                num_workers=segment_workers,
+                segment_seconds=data.segment_seconds,
+            ).run()
+            return True
+        if att_video_path.is_file():
+            att_video = VideoDataManager(
+                src_data=att_video_path,
+                output_dir=output_dir,
+                clean_work_dir=data.clean_work_dir,
+                streaming=data.video_streaming,
+                codec=data.video_codec,
+                crf=data.video_crf,
+                preset=data.video_preset,
+                threads=data.video_encoder_threads,
+                max_megapixels=decode_megapixels,
+            )
         assert not (att_video and att_image), "Only one attribute source can be used!"
         data_manager = att_video if att_video else att_image
         model = SimSwap(
-            config=config,
+            config=pipeline,
             id_image=id_image,
-
+            multispecific_gallery=multispecific_gallery,
         )
+        pipeline_workers = pipeline.pipeline_workers
+        if model.face_tracker is not None:
+            # The tracker relies on consecutive frames, so they must be swapped in order
+            pipeline_workers = min(pipeline_workers, 1)
+        frame_window_size = pipeline.frame_window_size
+        duplicate_frame_threshold = pipeline.duplicate_frame_threshold
+        if pipeline_workers > 0 or frame_window_size > 1 or duplicate_frame_threshold > 0:
+            PipelinedRunner(
+                model,
+                data_manager,
+                num_workers=max(pipeline_workers, 1),
+                max_in_flight=pipeline.pipeline_max_in_flight,
+                window_size=frame_window_size,
+                duplicate_threshold=duplicate_frame_threshold,
+                duplicate_max_diff=pipeline.duplicate_frame_max_diff,
+            ).run()
+            print(f"Networks loaded: {model.load_report()}")
+            return True
         for _ in tqdm(range(len(data_manager))):
             att_img = data_manager.get()
             output = model(att_img)
             result =data_manager.save(output)
+        data_manager.close()
+        print(f"Networks loaded: {model.load_report()}")
         return True
     except Exception as e:
         return e
@@ -55,33 +132,110 @@ import numpy as np
 from src.simswap import SimSwap
 from src.DataManager.ImageDataManager import ImageDataManager
 from src.DataManager.VideoDataManager import VideoDataManager
-from src.DataManager.utils import imread_rgb
+from src.DataManager.utils import imread_rgb, load_multispecific_gallery
+from src.Runner.bulk import BulkImageJob
+from src.Runner.pipeline import PipelinedRunner
+from src.Runner.segments import SegmentedVideoJob
 
 
 def run_application(config: DictConfig):
     try:
-        id_image_path = Path(config.id_image)
-        att_image_path = Path(config.att_image)
-        output_dir = Path(config.output_dir)
+        data, pipeline = config.data, config.pipeline
+        id_image_path = Path(data.id_image)
+        att_image_path = Path(data.att_image)
+        output_dir = Path(data.output_dir)
         assert id_image_path.exists(), f"Can't find {id_image_path} file!"
         id_image: Optional[np.ndarray] = imread_rgb(id_image_path)
+        multispecific_dir = data.multispecific_dir
+        multispecific_gallery = None
+        if multispecific_dir and multispecific_dir != "none":
+            multispecific_gallery = load_multispecific_gallery(multispecific_dir)
+        # Before any data manager is created, the bulk job reads the images itself
+        bulk_manifest = data.bulk_manifest
+        if bulk_manifest and bulk_manifest != "none":
+            num_failed = BulkImageJob(
+                config,
+                manifest_path=Path(bulk_manifest),
+                output_dir=output_dir,
+                id_image=id_image,
+                multispecific_gallery=multispecific_gallery,
+                shard_index=data.bulk_shard_index,
+                num_shards=data.bulk_num_shards,
+                num_workers=data.bulk_workers,
+            ).run()
+            assert num_failed == 0, f"{num_failed} images failed, see the status log in {output_dir}"
+            return True
         att_image: Optional[ImageDataManager] = None
+        # Inputs are decoded at the capped size unless the faces go back into the full resolution
+        decode_megapixels = pipeline.max_megapixels
+        if pipeline.restore_full_resolution:
+            decode_megapixels = 0
         if att_image_path and (att_image_path.is_file() or att_image_path.is_dir()):
             att_image: Optional[ImageDataManager] = ImageDataManager(
-                src_data=att_image_path, output_dir=output_dir
+                src_data=att_image_path,
+                output_dir=output_dir,
+                read_ahead=data.image_read_ahead,
+                write_workers=data.image_write_workers,
+                max_megapixels=decode_megapixels,
             )
         att_video: Optional[VideoDataManager] = None
+        att_video_path = Path(data.att_video)
+        segment_workers = data.segment_workers
+        if att_video_path.is_file() and segment_workers > 0:
+            assert not att_image, "Only one attribute source can be used!"
+            SegmentedVideoJob(
+                config,
+                src_video=att_video_path,
+                output_dir=output_dir,
+                id_image=id_image,
+                multispecific_gallery=multispecific_gallery,
+                num_workers=segment_workers,
+                segment_seconds=data.segment_seconds,
+            ).run()
+            return True
+        if att_video_path.is_file():
+            att_video = VideoDataManager(
+                src_data=att_video_path,
+                output_dir=output_dir,
+                clean_work_dir=data.clean_work_dir,
+                streaming=data.video_streaming,
+                codec=data.video_codec,
+                crf=data.video_crf,
+                preset=data.video_preset,
+                threads=data.video_encoder_threads,
+                max_megapixels=decode_megapixels,
+            )
         assert not (att_video and att_image), "Only one attribute source can be used!"
         data_manager = att_video if att_video else att_image
         model = SimSwap(
-            config=config,
+            config=pipeline,
             id_image=id_image,
-
+            multispecific_gallery=multispecific_gallery,
         )
+        pipeline_workers = pipeline.pipeline_workers
+        if model.face_tracker is not None:
+            # The tracker relies on consecutive frames, so they must be swapped in order
+            pipeline_workers = min(pipeline_workers, 1)
+        frame_window_size = pipeline.frame_window_size
+        duplicate_frame_threshold = pipeline.duplicate_frame_threshold
+        if pipeline_workers > 0 or frame_window_size > 1 or duplicate_frame_threshold > 0:
+            PipelinedRunner(
+                model,
+                data_manager,
+                num_workers=max(pipeline_workers, 1),
+                max_in_flight=pipeline.pipeline_max_in_flight,
+                window_size=frame_window_size,
+                duplicate_threshold=duplicate_frame_threshold,
+                duplicate_max_diff=pipeline.duplicate_frame_max_diff,
+            ).run()
+            print(f"Networks loaded: {model.load_report()}")
+            return True
         for _ in tqdm(range(len(data_manager))):
             att_img = data_manager.get()
             output = model(att_img)
             result =data_manager.save(output)
+        data_manager.close()
+        print(f"Networks loaded: {model.load_report()}")
         return True
     except Exception as e:
         return e
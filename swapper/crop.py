@@ -39,32 +39,78 @@
 
 
 
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import os
+from typing import Tuple
+
+WATERMARK_TEXT = "faceswapperonline.com"
+# Watermarks are rendered once per this many pixels of the image width
+WATERMARK_WIDTH_BUCKET = 16
+
+
+@lru_cache(maxsize=None)
+def load_font(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype("arial.ttf", size)
+
+
+@lru_cache(maxsize=256)
+def watermark_tile(bucket_width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Renders the watermark box for images of 'bucket_width' width.
+
+    Returns the colour premultiplied by the alpha (the part that is simply added)
+    and 1 - alpha (the weight of the image under it), both float32 HxWx1/3.
+    """
+    box_width = bucket_width // 3
+    box_height = box_width // 6
+    font = load_font(max(box_height // 2, 1))
+    watermark_box = Image.new('RGBA', (box_width, box_height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(watermark_box)
+    draw.text((box_width * 0.070, box_height * 0.25), WATERMARK_TEXT, fill=(255, 255, 255), font=font)
+
+    tile = np.asarray(watermark_box, dtype=np.float32)
+    alpha = tile[..., 3:] / 255.0
+
+    return tile[..., :3] * alpha, 1.0 - alpha
+
+
+def add_watermark(image: np.ndarray) -> np.ndarray:
+    # Alpha-composites the watermark into the bottom right corner of an RGB(A) uint8 image, in place
+    height, width = image.shape[:2]
+    bucket_width = max(width - width % WATERMARK_WIDTH_BUCKET, WATERMARK_WIDTH_BUCKET)
+    premultiplied, inv_alpha = watermark_tile(bucket_width)
+
+    box_height, box_width = premultiplied.shape[:2]
+    x = width - box_width - 10
+    y = height - box_height - 10
+    if box_height == 0 or x < 0 or y < 0:
+        return image
+
+    region = image[y:y + box_height, x:x + box_width]
+    region[..., :3] = np.clip(region[..., :3] * inv_alpha + premultiplied + 0.5, 0, 255).astype(np.uint8)
+    if image.shape[2] == 4:
+        # The text is opaque over transparent pixels too
+        region[..., 3:] = np.clip(region[..., 3:] * inv_alpha + 255.0 * (1.0 - inv_alpha) + 0.5, 0, 255).astype(np.uint8)
+
+    return image
+
+
+def save_watermarked(image: np.ndarray, image_name: str) -> str:
+    # The watermarked copy of an in-memory result, encoded once next to 'img'
+    final_path = os.path.abspath(os.path.join(os.getcwd(), '..', "public", image_name))
+    Image.fromarray(add_watermark(image.copy())).save(final_path)
+    return image_name
+
 
 def watermark_adder (image_name:str,save_path:str):
     try:
         img_path=(os.path.abspath(os.path.join(os.getcwd(),'..',"public","img",image_name)))
-        id_image = Image.open(img_path)
-        text = "faceswapperonline.com"
-        font = ImageFont.truetype("arial.ttf", 50)
-        image_resolution = id_image.size
-        box_width = image_resolution[0] // 3
-        box_height = box_width // 6
-        text_size = box_height // 2
-        font = ImageFont.truetype("arial.ttf", text_size)
-        x = image_resolution[0] - box_width - 10
-        y = image_resolution[1] - box_height - 10
-        watermark_box = Image.new('RGBA', (box_width, box_height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark_box)
-        draw.text((box_width * 0.070, box_height * 0.25), text, fill=(255, 255, 255), font=font)
-        id_image.paste(watermark_box, (x, y), watermark_box)
-        final_path=os.path.abspath(os.path.join(os.getcwd(),'..',"public",image_name))
-        id_image.save(final_path)
-        id_image.close()
-        return image_name
+        with Image.open(img_path) as id_image:
+            # Images with transparency keep it
+            has_alpha = id_image.mode in ("RGBA", "LA", "PA") or "transparency" in id_image.info
+            image = np.array(id_image.convert("RGBA" if has_alpha else "RGB"))
+        return save_watermarked(image, image_name)
     except BaseException as error :
         print('An exception occurred: {}'.format(error))
         return False
-
@@ -1,12 +1,26 @@
 from src.DataManager.base import BaseDataManager
-from src.DataManager.utils import imread_rgb, imwrite_rgb
+from src.DataManager.utils import imread_rgb_limited, imwrite_rgb
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
 import numpy as np
+from typing import Deque, Optional
 from pathlib import Path
 
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
 class ImageDataManager(BaseDataManager):
-    def __init__(self, src_data: Path, output_dir: Path):
+    def __init__(
+        self,
+        src_data: Path,
+        output_dir: Path,
+        read_ahead: int = 0,
+        write_workers: int = 0,
+        max_megapixels: float = 0,
+    ):
         self.output_dir: Path = output_dir
         self.output_dir.mkdir(exist_ok=True)
         self.output_dir = output_dir / "img"
@@ -16,11 +30,13 @@ class ImageDataManager(BaseDataManager):
         if src_data.is_file():
             self.data_paths.append(src_data)
         elif src_data.is_dir():
-            self.data_paths = (
-                list(src_data.glob("*.jpg"))
-                + list(src_data.glob("*.jpeg"))
-                + list(src_data.glob("*.png"))
-            )
+            # A single directory pass instead of a glob per extension
+            with os.scandir(src_data) as entries:
+                self.data_paths = sorted(
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file()
+                )
 
         assert len(self.data_paths), "Data must be supplied!"
 
@@ -28,28 +44,98 @@ class ImageDataManager(BaseDataManager):
 
         self.last_idx = -1
 
+        # Large JPEGs are decoded at a reduced size right away (0 - full size)
+        self.max_megapixels = max_megapixels
+
+        # Images decoded in the background, in the reading order
+        self.read_ahead = read_ahead
+        self.reader: Optional[ThreadPoolExecutor] = None
+        self.read_queue: Deque[Future] = deque()
+        if self.read_ahead > 0:
+            self.reader = ThreadPoolExecutor(max_workers=min(read_ahead, os.cpu_count() or 1))
+            for _ in range(read_ahead):
+                self._read_next()
+
+        # Outputs encoded in the background, at most two per worker are waiting
+        self.writer: Optional[ThreadPoolExecutor] = None
+        self.write_queue: Deque[Future] = deque()
+        self.max_pending_writes = 2 * write_workers
+        if write_workers > 0:
+            self.writer = ThreadPoolExecutor(max_workers=write_workers)
+
     def __len__(self):
         return len(self.data_paths)
 
+    def _read_next(self) -> None:
+        img_path = next(self.data_paths_iter, None)
+        if img_path is not None:
+            self.read_queue.append(
+                self.reader.submit(imread_rgb_limited, img_path, self.max_megapixels)
+            )
+
     def get(self) -> np.ndarray:
-        img_path = next(self.data_paths_iter)
+        if self.reader is None:
+            img_path = next(self.data_paths_iter)
+            self.last_idx += 1
+            return imread_rgb_limited(img_path, self.max_megapixels)
+
+        if not self.read_queue:
+            raise StopIteration
+
+        img = self.read_queue.popleft().result()
         self.last_idx += 1
-        return imread_rgb(img_path)
+        self._read_next()
+
+        return img
 
-    def save(self, img: np.ndarray):
-        filename = "swap_" + Path(self.data_paths[self.last_idx]).name
+    def save(self, img: np.ndarray, idx: Optional[int] = None):
+        idx = self.last_idx if idx is None else idx
+        filename = "swap_" + Path(self.data_paths[idx]).name
         
-        imwrite_rgb(self.output_dir / filename, img)
+        if self.writer is None:
+            imwrite_rgb(self.output_dir / filename, img)
+            return
+
+        # Bounds the memory held by pending outputs and surfaces write errors early
+        while len(self.write_queue) >= self.max_pending_writes:
+            self.write_queue.popleft().result()
+
+        self.write_queue.append(self.writer.submit(imwrite_rgb, self.output_dir / filename, img))
+
+    def close(self):
+        while self.write_queue:
+            self.write_queue.popleft().result()
+
+        for pool in (self.reader, self.writer):
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        self.reader = None
+        self.writer = None
+        self.read_queue.clear()
 
 from src.DataManager.base import BaseDataManager
-from src.DataManager.utils import imread_rgb, imwrite_rgb
+from src.DataManager.utils import imread_rgb_limited, imwrite_rgb
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
 import numpy as np
+from typing import Deque, Optional
 from pathlib import Path
 
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
 class ImageDataManager(BaseDataManager):
-    def __init__(self, src_data: Path, output_dir: Path):
+    def __init__(
+        self,
+        src_data: Path,
+        output_dir: Path,
+        read_ahead: int = 0,
+        write_workers: int = 0,
+        max_megapixels: float = 0,
+    ):
         self.output_dir: Path = output_dir
         self.output_dir.mkdir(exist_ok=True)
         self.output_dir = output_dir / "img"
@@ -59,11 +145,13 @@ class ImageDataManager(BaseDataManager):
         if src_data.is_file():
             self.data_paths.append(src_data)
         elif src_data.is_dir():
-            self.data_paths = (
-                list(src_data.glob("*.jpg"))
-                + list(src_data.glob("*.jpeg"))
-                + list(src_data.glob("*.png"))
-            )
+            # A single directory pass instead of a glob per extension
+            with os.scandir(src_data) as entries:
+                self.data_paths = sorted(
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file()
+                )
 
         assert len(self.data_paths), "Data must be supplied!"
 
@@ -71,15 +159,71 @@ class ImageDataManager(BaseDataManager):
 
         self.last_idx = -1
 
+        # Large JPEGs are decoded at a reduced size right away (0 - full size)
+        self.max_megapixels = max_megapixels
+
+        # Images decoded in the background, in the reading order
+        self.read_ahead = read_ahead
+        self.reader: Optional[ThreadPoolExecutor] = None
+        self.read_queue: Deque[Future] = deque()
+        if self.read_ahead > 0:
+            self.reader = ThreadPoolExecutor(max_workers=min(read_ahead, os.cpu_count() or 1))
+            for _ in range(read_ahead):
+                self._read_next()
+
+        # Outputs encoded in the background, at most two per worker are waiting
+        self.writer: Optional[ThreadPoolExecutor] = None
+        self.write_queue: Deque[Future] = deque()
+        self.max_pending_writes = 2 * write_workers
+        if write_workers > 0:
+            self.writer = ThreadPoolExecutor(max_workers=write_workers)
+
     def __len__(self):
         return len(self.data_paths)
 
+    def _read_next(self) -> None:
+        img_path = next(self.data_paths_iter, None)
+        if img_path is not None:
+            self.read_queue.append(
+                self.reader.submit(imread_rgb_limited, img_path, self.max_megapixels)
+            )
+
     def get(self) -> np.ndarray:
-        img_path = next(self.data_paths_iter)
+        if self.reader is None:
+            img_path = next(self.data_paths_iter)
+            self.last_idx += 1
+            return imread_rgb_limited(img_path, self.max_megapixels)
+
+        if not self.read_queue:
+            raise StopIteration
+
+        img = self.read_queue.popleft().result()
         self.last_idx += 1
-        return imread_rgb(img_path)
+        self._read_next()
+
+        return img
 
-    def save(self, img: np.ndarray):
-        filename = "swap_" + Path(self.data_paths[self.last_idx]).name
+    def save(self, img: np.ndarray, idx: Optional[int] = None):
+        idx = self.last_idx if idx is None else idx
+        filename = "swap_" + Path(self.data_paths[idx]).name
         
-        imwrite_rgb(self.output_dir / filename, img)
+        if self.writer is None:
+            imwrite_rgb(self.output_dir / filename, img)
+            return
+
+        # Bounds the memory held by pending outputs and surfaces write errors early
+        while len(self.write_queue) >= self.max_pending_writes:
+            self.write_queue.popleft().result()
+
+        self.write_queue.append(self.writer.submit(imwrite_rgb, self.output_dir / filename, img))
+
+    def close(self):
+        while self.write_queue:
+            self.write_queue.popleft().result()
+
+        for pool in (self.reader, self.writer):
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        self.reader = None
+        self.writer = None
+        self.read_queue.clear()
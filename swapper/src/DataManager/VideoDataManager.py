@@ -1,5 +1,13 @@
 from src.DataManager.base import BaseDataManager
 from src.DataManager.utils import imwrite_rgb
+from src.Misc.utils import limit_resolution, limited_size
+from src.DataManager.ffmpeg_utils import (
+    FFmpegWriter,
+    mux_audio,
+    probe_audio_codec,
+    probe_video_timing,
+    video_only_path,
+)
 
 import cv2
 import numpy as np
@@ -7,27 +15,43 @@ from pathlib import Path
 import shutil
 from typing import Optional, Union
 
-from moviepy.editor import AudioFileClip, VideoFileClip
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
-
 
 class VideoDataManager(BaseDataManager):
-    def __init__(self, src_data: Path, output_dir: Path, clean_work_dir: bool = False):
+    def __init__(
+        self,
+        src_data: Path,
+        output_dir: Path,
+        clean_work_dir: bool = False,
+        streaming: bool = False,
+        codec: str = "libx264",
+        crf: int = 18,
+        preset: str = "medium",
+        threads: int = 0,
+        max_megapixels: float = 0,
+    ):
         self.video_handle: Optional[cv2.VideoCapture] = None
-        self.audio_handle: Optional[AudioFileClip] = None
+        self.src_data = src_data
+        self.has_audio = False
+        self.writer: Optional[FFmpegWriter] = None
 
         self.output_dir = output_dir
         self.output_img_dir = output_dir / "img"
         self.output_dir.mkdir(exist_ok=True)
-        self.output_img_dir.mkdir(exist_ok=True)
         self.video_name = None
         self.clean_work_dir = clean_work_dir
+        # Stream frames to an ffmpeg encoder instead of saving them as images
+        self.streaming = streaming
+        # Frames larger than this are downscaled right after decoding (0 - keep the size)
+        self.max_megapixels = max_megapixels
+
+        if not self.streaming:
+            self.output_img_dir.mkdir(exist_ok=True)
 
         if src_data.is_file():
             self.video_name = "swap_" + src_data.name
 
-            if VideoFileClip(str(src_data)).audio is not None:
-                self.audio_handle = AudioFileClip(str(src_data))
+            if not self.streaming:
+                self.has_audio = probe_audio_codec(src_data) is not None
 
             self.video_handle = cv2.VideoCapture(str(src_data))
             self.video_handle.set(cv2.CAP_PROP_POS_FRAMES, 0)
@@ -35,7 +59,27 @@ class VideoDataManager(BaseDataManager):
             self.frame_count = int(self.video_handle.get(cv2.CAP_PROP_FRAME_COUNT))
             self.fps = self.video_handle.get(cv2.CAP_PROP_FPS)
 
+            if self.streaming:
+                frame_size = limited_size(
+                    int(self.video_handle.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    int(self.video_handle.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    max_megapixels,
+                )
+                frame_rate, timescale = probe_video_timing(src_data)
+                self.writer = FFmpegWriter(
+                    self.output_dir / self.video_name,
+                    fps=frame_rate or self.fps,
+                    frame_size=frame_size,
+                    codec=codec,
+                    crf=crf,
+                    preset=preset,
+                    threads=threads,
+                    audio_source=src_data,
+                    timescale=timescale or 0,
+                )
+
         self.last_idx = -1
+        self.closed = False
 
         assert self.video_handle, "Video file must be specified!"
 
@@ -50,30 +94,62 @@ class VideoDataManager(BaseDataManager):
             self.last_idx += 1
 
         if img is not None:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            img = limit_resolution(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), self.max_megapixels)
         return img
 
-    def save(self, img: np.ndarray):
-        filename = "frame_{:0>7d}.jpg".format(self.last_idx)
-        imwrite_rgb(self.output_img_dir / filename, img)
+    def save(self, img: np.ndarray, idx: Optional[int] = None):
+        idx = self.last_idx if idx is None else idx
+
+        if self.streaming:
+            self.writer.write(img)
+        else:
+            filename = "frame_{:0>7d}.jpg".format(idx)
+            imwrite_rgb(self.output_img_dir / filename, img)
+
+        if (self.frame_count - 1) == idx:
+            self.close()
 
-        if (self.frame_count - 1) == self.last_idx:
-            self._close()
+    def close(self):
+        # Safe to call several times, e.g. after the last frame and again on an early exit
+        if self.closed:
+            return
+
+        self.closed = True
+        self._close()
 
     def _close(self):
+        if self.streaming:
+            self.writer.close()
+            return
+
+        # moviepy is only needed here, the streaming mode works without it
+        from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
+
         image_filenames = [str(x) for x in sorted(self.output_img_dir.glob("*.jpg"))]
         clip = ImageSequenceClip(image_filenames, fps=self.fps)
 
-        if self.audio_handle is not None:
-            clip = clip.set_audio(self.audio_handle)
-
-        clip.write_videofile(str(self.output_dir / self.video_name))
+        output_path = self.output_dir / self.video_name
+        if self.has_audio:
+            # The source audio is copied as is, not decoded and re-encoded by moviepy
+            clip.write_videofile(str(video_only_path(output_path)), audio=False)
+            mux_audio(video_only_path(output_path), self.src_data, output_path)
+            video_only_path(output_path).unlink()
+        else:
+            clip.write_videofile(str(output_path))
 
         if self.clean_work_dir:
             shutil.rmtree(self.output_img_dir, ignore_errors=True)
 
 from src.DataManager.base import BaseDataManager
 from src.DataManager.utils import imwrite_rgb
+from src.Misc.utils import limit_resolution, limited_size
+from src.DataManager.ffmpeg_utils import (
+    FFmpegWriter,
+    mux_audio,
+    probe_audio_codec,
+    probe_video_timing,
+    video_only_path,
+)
 
 import cv2
 import numpy as np
@@ -81,27 +157,43 @@ from pathlib import Path
 import shutil
 from typing import Optional, Union
 
-from moviepy.editor import AudioFileClip, VideoFileClip
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
-
 
 class VideoDataManager(BaseDataManager):
-    def __init__(self, src_data: Path, output_dir: Path, clean_work_dir: bool = False):
+    def __init__(
+        self,
+        src_data: Path,
+        output_dir: Path,
+        clean_work_dir: bool = False,
+        streaming: bool = False,
+        codec: str = "libx264",
+        crf: int = 18,
+        preset: str = "medium",
+        threads: int = 0,
+        max_megapixels: float = 0,
+    ):
         self.video_handle: Optional[cv2.VideoCapture] = None
-        self.audio_handle: Optional[AudioFileClip] = None
+        self.src_data = src_data
+        self.has_audio = False
+        self.writer: Optional[FFmpegWriter] = None
 
         self.output_dir = output_dir
         self.output_img_dir = output_dir / "img"
         self.output_dir.mkdir(exist_ok=True)
-        self.output_img_dir.mkdir(exist_ok=True)
         self.video_name = None
         self.clean_work_dir = clean_work_dir
+        # Stream frames to an ffmpeg encoder instead of saving them as images
+        self.streaming = streaming
+        # Frames larger than this are downscaled right after decoding (0 - keep the size)
+        self.max_megapixels = max_megapixels
+
+        if not self.streaming:
+            self.output_img_dir.mkdir(exist_ok=True)
 
         if src_data.is_file():
             self.video_name = "swap_" + src_data.name
 
-            if VideoFileClip(str(src_data)).audio is not None:
-                self.audio_handle = AudioFileClip(str(src_data))
+            if not self.streaming:
+                self.has_audio = probe_audio_codec(src_data) is not None
 
             self.video_handle = cv2.VideoCapture(str(src_data))
             self.video_handle.set(cv2.CAP_PROP_POS_FRAMES, 0)
@@ -109,7 +201,27 @@ class VideoDataManager(BaseDataManager):
             self.frame_count = int(self.video_handle.get(cv2.CAP_PROP_FRAME_COUNT))
             self.fps = self.video_handle.get(cv2.CAP_PROP_FPS)
 
+            if self.streaming:
+                frame_size = limited_size(
+                    int(self.video_handle.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    int(self.video_handle.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    max_megapixels,
+                )
+                frame_rate, timescale = probe_video_timing(src_data)
+                self.writer = FFmpegWriter(
+                    self.output_dir / self.video_name,
+                    fps=frame_rate or self.fps,
+                    frame_size=frame_size,
+                    codec=codec,
+                    crf=crf,
+                    preset=preset,
+                    threads=threads,
+                    audio_source=src_data,
+                    timescale=timescale or 0,
+                )
+
         self.last_idx = -1
+        self.closed = False
 
         assert self.video_handle, "Video file must be specified!"
 
@@ -124,24 +236,48 @@ class VideoDataManager(BaseDataManager):
             self.last_idx += 1
 
         if img is not None:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            img = limit_resolution(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), self.max_megapixels)
         return img
 
-    def save(self, img: np.ndarray):
-        filename = "frame_{:0>7d}.jpg".format(self.last_idx)
-        imwrite_rgb(self.output_img_dir / filename, img)
+    def save(self, img: np.ndarray, idx: Optional[int] = None):
+        idx = self.last_idx if idx is None else idx
+
+        if self.streaming:
+            self.writer.write(img)
+        else:
+            filename = "frame_{:0>7d}.jpg".format(idx)
+            imwrite_rgb(self.output_img_dir / filename, img)
+
+        if (self.frame_count - 1) == idx:
+            self.close()
 
-        if (self.frame_count - 1) == self.last_idx:
-            self._close()
+    def close(self):
+        # Safe to call several times, e.g. after the last frame and again on an early exit
+        if self.closed:
+            return
+
+        self.closed = True
+        self._close()
 
     def _close(self):
+        if self.streaming:
+            self.writer.close()
+            return
+
+        # moviepy is only needed here, the streaming mode works without it
+        from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
+
         image_filenames = [str(x) for x in sorted(self.output_img_dir.glob("*.jpg"))]
         clip = ImageSequenceClip(image_filenames, fps=self.fps)
 
-        if self.audio_handle is not None:
-            clip = clip.set_audio(self.audio_handle)
-
-        clip.write_videofile(str(self.output_dir / self.video_name))
+        output_path = self.output_dir / self.video_name
+        if self.has_audio:
+            # The source audio is copied as is, not decoded and re-encoded by moviepy
+            clip.write_videofile(str(video_only_path(output_path)), audio=False)
+            mux_audio(video_only_path(output_path), self.src_data, output_path)
+            video_only_path(output_path).unlink()
+        else:
+            clip.write_videofile(str(output_path))
 
         if self.clean_work_dir:
             shutil.rmtree(self.output_img_dir, ignore_errors=True)
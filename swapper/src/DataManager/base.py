@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 import numpy as np
+from typing import Optional
 
 
 class BaseDataManager(ABC):
@@ -12,11 +13,17 @@ class BaseDataManager(ABC):
         pass
 
     @abstractmethod
-    def save(self, img: np.ndarray) -> None:
+    def save(self, img: np.ndarray, idx: Optional[int] = None) -> None:
+        # idx is the 'last_idx' the image was read with, defaults to the last read image
+        pass
+
+    def close(self) -> None:
+        # Flushes pending outputs and releases resources, safe to call several times
         pass
 
 from abc import ABC, abstractmethod
 import numpy as np
+from typing import Optional
 
 
 class BaseDataManager(ABC):
@@ -29,5 +36,10 @@ class BaseDataManager(ABC):
         pass
 
     @abstractmethod
-    def save(self, img: np.ndarray) -> None:
+    def save(self, img: np.ndarray, idx: Optional[int] = None) -> None:
+        # idx is the 'last_idx' the image was read with, defaults to the last read image
+        pass
+
+    def close(self) -> None:
+        # Flushes pending outputs and releases resources, safe to call several times
         pass
@@ -0,0 +1,212 @@
+import re
+import subprocess
+import tempfile
+from fractions import Fraction
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+
+# Encoders with a constant quality mode set by '-crf', the others use their default rate control
+CRF_CODECS = ("libx264", "libx265", "libvpx-vp9", "libaom-av1", "libsvtav1")
+
+
+def get_ffmpeg_binary() -> str:
+    # moviepy ships (or is configured with) an ffmpeg binary, prefer it over the one on PATH
+    try:
+        from moviepy.config import get_setting
+
+        return get_setting("FFMPEG_BINARY")
+    except ImportError:
+        return "ffmpeg"
+
+
+def read_stream_info(path: Union[str, Path]) -> str:
+    # Only the container header is read: 'ffmpeg -i' without an output prints the
+    # stream list and exits, no stream is decoded (and ffprobe isn't required)
+    proc = subprocess.run(
+        [get_ffmpeg_binary(), "-hide_banner", "-i", str(path)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    return proc.stderr.decode(errors="ignore")
+
+
+def probe_audio_codec(path: Union[str, Path]) -> Optional[str]:
+    """Returns the codec name of the first audio stream, None if there's no audio."""
+    match = re.search(r"Stream #\d+:\d+.*?: Audio: (\w+)", read_stream_info(path))
+
+    return match.group(1) if match else None
+
+
+def parse_rate(text: str) -> Fraction:
+    # ffmpeg prints rates rounded to 2 decimals ('29.97') or in thousands ('90k')
+    rate = Fraction(text[:-1]) * 1000 if text.endswith("k") else Fraction(text)
+    if rate.denominator != 1:
+        # NTSC rates are N*1000/1001, the rounded value would drift by 0.01 fps
+        ntsc_rate = Fraction(round(rate * Fraction(1001, 1000)) * 1000, 1001)
+        if abs(ntsc_rate - rate) < Fraction(1, 100):
+            return ntsc_rate
+
+    return rate
+
+
+def probe_video_timing(path: Union[str, Path]) -> Tuple[Optional[Fraction], Optional[int]]:
+    """Returns the frame rate and the time base of the first video stream, None if unknown.
+
+    The rate is the average one ('fps'): for a variable frame rate video, encoding the
+    frames at it keeps the duration of the source, unlike the base rate ('tbr') that
+    cv2 reports. The time base is the denominator, as for '-video_track_timescale'.
+    """
+    match = re.search(r"Stream #\d+:\d+.*?: Video: .*", read_stream_info(path))
+    if match is None:
+        return None, None
+
+    fps = re.search(r"([\d.]+k?) (?:fps|tbr)", match.group(0))
+    tbn = re.search(r"([\d.]+k?) tbn", match.group(0))
+
+    return (
+        parse_rate(fps.group(1)) if fps else None,
+        int(parse_rate(tbn.group(1))) if tbn else None,
+    )
+
+
+def mux_audio(
+    video_path: Union[str, Path], audio_source: Union[str, Path], output_path: Union[str, Path]
+) -> None:
+    """Puts the video stream of 'video_path' and the first audio stream of 'audio_source' together.
+
+    Both streams are copied bit-exactly. Only if the output container can't hold the
+    source audio codec, the audio is re-encoded to AAC.
+    """
+    base_cmd = [
+        get_ffmpeg_binary(),
+        "-y",
+        "-loglevel", "error",
+        "-i", str(video_path),
+        "-i", str(audio_source),
+        "-map", "0:v:0",
+        "-map", "1:a:0?",
+        "-c:v", "copy",
+        "-shortest",
+    ]
+
+    error = b""
+    for audio_codec in ("copy", "aac"):
+        proc = subprocess.run(
+            base_cmd + ["-c:a", audio_codec, str(output_path)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if proc.returncode == 0:
+            return
+        error = proc.stderr
+
+    raise RuntimeError(f"ffmpeg failed to mux {output_path}: {error.decode(errors='ignore')}")
+
+
+def video_only_path(output_path: Path) -> Path:
+    # Temporary file for the encoded video before the audio is muxed in
+    return output_path.with_name(output_path.stem + ".video" + output_path.suffix)
+
+
+class FFmpegWriter:
+    """Encodes RGB frames by piping them to an ffmpeg subprocess.
+
+    Frames are encoded as they are produced, there are no intermediate image files.
+    If 'audio_source' has audio, its first audio stream is copied into the output on close.
+    """
+
+    def __init__(
+        self,
+        output_path: Union[str, Path],
+        fps: Union[float, Fraction],
+        frame_size: Tuple[int, int],
+        codec: str = "libx264",
+        crf: int = 18,
+        preset: str = "medium",
+        threads: int = 0,
+        audio_source: Optional[Union[str, Path]] = None,
+        timescale: int = 0,
+    ):
+        self.output_path = Path(output_path)
+        self.frame_size = frame_size
+        self.audio_source = audio_source
+        if audio_source is not None and probe_audio_codec(audio_source) is None:
+            self.audio_source = None
+
+        # With audio, the video is encoded to a temporary file first and muxed on close
+        self.video_path = (
+            video_only_path(self.output_path) if self.audio_source is not None else self.output_path
+        )
+
+        width, height = frame_size
+        cmd = [
+            get_ffmpeg_binary(),
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-vcodec", "rawvideo",
+            "-s", f"{width}x{height}",
+            "-pix_fmt", "rgb24",
+            "-r", f"{fps}",
+            "-i", "-",
+        ]
+
+        cmd += ["-c:v", codec]
+        if codec in CRF_CODECS:
+            cmd += ["-crf", str(crf)]
+            if codec in ("libvpx-vp9", "libaom-av1"):
+                # Otherwise the bitrate limit applies too and the quality isn't constant
+                cmd += ["-b:v", "0"]
+        cmd += [
+            "-preset", preset,
+            "-threads", str(threads),
+            # yuv420p requires even frame dimensions
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-pix_fmt", "yuv420p",
+        ]
+        if timescale > 0 and self.video_path.suffix.lower() in (".mp4", ".mov", ".m4v"):
+            # The source time base, the frames keep exactly representable timestamps
+            cmd += ["-video_track_timescale", str(timescale)]
+        cmd.append(str(self.video_path))
+
+        # A file rather than a pipe: nobody reads it while encoding, a full pipe would block ffmpeg
+        self.stderr_file = tempfile.TemporaryFile()
+        self.proc: Optional[subprocess.Popen] = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stderr=self.stderr_file
+        )
+
+    def write(self, frame: np.ndarray) -> None:
+        assert (frame.shape[1], frame.shape[0]) == self.frame_size, (
+            f"Frame size {frame.shape[1]}x{frame.shape[0]} doesn't match "
+            f"the video size {self.frame_size[0]}x{self.frame_size[1]}!"
+        )
+
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        except BrokenPipeError:
+            self.close()
+
+    def close(self) -> None:
+        if self.proc is None:
+            return
+
+        proc, self.proc = self.proc, None
+        proc.stdin.close()
+        returncode = proc.wait()
+
+        self.stderr_file.seek(0)
+        error = self.stderr_file.read()
+        self.stderr_file.close()
+
+        if returncode != 0:
+            raise RuntimeError(
+                f"ffmpeg failed to encode {self.video_path}: {error.decode(errors='ignore')}"
+            )
+
+        if self.audio_source is not None:
+            mux_audio(self.video_path, self.audio_source, self.output_path)
+            self.video_path.unlink()
@@ -1,25 +1,107 @@
 import cv2
 import numpy as np
 from pathlib import Path
-from typing import Union
+from typing import List, Tuple, Union
+from PIL import Image
+
+from src.Misc.utils import limit_resolution
 
 
 def imread_rgb(img_path: Union[str, Path]) -> np.ndarray:
     return cv2.cvtColor(cv2.imread(str(img_path)), cv2.COLOR_BGR2RGB)
 
 
+def imread_rgb_limited(img_path: Union[str, Path], max_megapixels: float) -> np.ndarray:
+    # Decodes a JPEG straight at 1/2, 1/4 or 1/8 of its size when it is much larger than
+    # max_megapixels, so the full resolution image is never held in memory
+    img_path = Path(img_path)
+    flags = cv2.IMREAD_COLOR
+    if max_megapixels > 0 and img_path.suffix.lower() in (".jpg", ".jpeg"):
+        with Image.open(img_path) as img:
+            width, height = img.size
+
+        for factor, reduced_flags in (
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+        ):
+            # The largest reduction which still keeps at least max_megapixels
+            if width * height / factor ** 2 >= max_megapixels * 1e6:
+                flags = reduced_flags
+                break
+
+    img = cv2.cvtColor(cv2.imread(str(img_path), flags), cv2.COLOR_BGR2RGB)
+
+    return limit_resolution(img, max_megapixels)
+
+
 def imwrite_rgb(img_path: Union[str, Path], img):
     return cv2.imwrite(str(img_path), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
+
+def load_multispecific_gallery(gallery_dir: Union[str, Path]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # Pairs DST_xx (a specific person on the target) with SRC_xx (the identity to put on that person)
+    gallery_dir = Path(gallery_dir)
+    gallery = []
+    for dst_path in sorted(gallery_dir.glob("DST_*")):
+        src_paths = list(gallery_dir.glob("SRC_" + dst_path.stem[len("DST_"):] + ".*"))
+        assert src_paths, f"Can't find a source image for {dst_path.name}!"
+        gallery.append((imread_rgb(dst_path), imread_rgb(src_paths[0])))
+
+    assert gallery, f"Can't find DST_*/SRC_* image pairs in {gallery_dir}!"
+
+    return gallery
+
 import cv2
 import numpy as np
 from pathlib import Path
-from typing import Union
+from typing import List, Tuple, Union
+from PIL import Image
+
+from src.Misc.utils import limit_resolution
 
 
 def imread_rgb(img_path: Union[str, Path]) -> np.ndarray:
     return cv2.cvtColor(cv2.imread(str(img_path)), cv2.COLOR_BGR2RGB)
 
 
+def imread_rgb_limited(img_path: Union[str, Path], max_megapixels: float) -> np.ndarray:
+    # Decodes a JPEG straight at 1/2, 1/4 or 1/8 of its size when it is much larger than
+    # max_megapixels, so the full resolution image is never held in memory
+    img_path = Path(img_path)
+    flags = cv2.IMREAD_COLOR
+    if max_megapixels > 0 and img_path.suffix.lower() in (".jpg", ".jpeg"):
+        with Image.open(img_path) as img:
+            width, height = img.size
+
+        for factor, reduced_flags in (
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+        ):
+            # The largest reduction which still keeps at least max_megapixels
+            if width * height / factor ** 2 >= max_megapixels * 1e6:
+                flags = reduced_flags
+                break
+
+    img = cv2.cvtColor(cv2.imread(str(img_path), flags), cv2.COLOR_BGR2RGB)
+
+    return limit_resolution(img, max_megapixels)
+
+
 def imwrite_rgb(img_path: Union[str, Path], img):
     return cv2.imwrite(str(img_path), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+
+
+def load_multispecific_gallery(gallery_dir: Union[str, Path]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # Pairs DST_xx (a specific person on the target) with SRC_xx (the identity to put on that person)
+    gallery_dir = Path(gallery_dir)
+    gallery = []
+    for dst_path in sorted(gallery_dir.glob("DST_*")):
+        src_paths = list(gallery_dir.glob("SRC_" + dst_path.stem[len("DST_"):] + ".*"))
+        assert src_paths, f"Can't find a source image for {dst_path.name}!"
+        gallery.append((imread_rgb(dst_path), imread_rgb(src_paths[0])))
+
+    assert gallery, f"Can't find DST_*/SRC_* image pairs in {gallery_dir}!"
+
+    return gallery
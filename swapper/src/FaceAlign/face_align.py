@@ -1,8 +1,7 @@
 import cv2
 import numpy as np
 import torch
-from skimage import transform as skt
-from typing import Iterable, Tuple
+from typing import Iterable, Tuple, Union
 
 src1 = np.array(
     [
@@ -77,40 +76,76 @@ ffhq_src = np.array(
 ffhq_src = np.expand_dims(ffhq_src, axis=0)
 
 
-# arcface_src = np.array(
-#     [[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366],
-#      [41.5493, 92.3655], [70.7299, 92.2041]],
-#     dtype=np.float32)
+# Reference key points ArcFace was trained with (112x112 crops)
+arcface_src = np.array(
+    [[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366],
+     [41.5493, 92.3655], [70.7299, 92.2041]],
+    dtype=np.float32)
 
-# arcface_src = np.expand_dims(arcface_src, axis=0)
+arcface_src = np.expand_dims(arcface_src, axis=0)
 
 # In[66]:
 
 
-# lmk is prediction; src is template
-def estimate_norm(lmk, image_size=112, mode="ffhq"):
-    assert lmk.shape == (5, 2)
-    tform = skt.SimilarityTransform()
-    lmk_tran = np.insert(lmk, 2, values=np.ones(5), axis=1)
-    min_M = []
-    min_index = []
-    min_error = float("inf")
+def umeyama_batch(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """Estimates similarity transforms mapping 'src' points to 'dst' points.
+
+    Vectorized version of the Umeyama algorithm used by skimage.SimilarityTransform:
+    src, dst - [..., N, 2] point sets, returns [..., 2, 3] transformation matrices.
+    """
+    num = src.shape[-2]
+
+    src_mean = src.mean(axis=-2, keepdims=True)
+    dst_mean = dst.mean(axis=-2, keepdims=True)
+    src_demean = src - src_mean
+    dst_demean = dst - dst_mean
+
+    A = np.swapaxes(dst_demean, -1, -2) @ src_demean / num
+
+    d = np.ones(A.shape[:-2] + (2,), dtype=np.float64)
+    d[np.linalg.det(A) < 0, 1] = -1
+
+    U, S, V = np.linalg.svd(A)
+    R = U @ (d[..., None] * V)
+
+    scale = np.sum(S * d, axis=-1) / src_demean.var(axis=-2).sum(axis=-1)
+    R = R * scale[..., None, None]
+
+    t = dst_mean[..., 0, :] - (R @ src_mean[..., 0, :, None])[..., 0]
+
+    return np.concatenate([R, t[..., None]], axis=-1)
+
+
+def estimate_norm_batch(
+    lmks: np.ndarray, image_size: int = 112, mode: str = "ffhq"
+) -> Tuple[np.ndarray, np.ndarray]:
+    # lmks: [F, 5, 2] predictions, returns the best [F, 2, 3] transforms and template indices
+    assert lmks.ndim == 3 and lmks.shape[1:] == (5, 2)
     if mode == "ffhq":
-        # assert image_size == 112
         src = ffhq_src * image_size / 512
+    elif mode == "arcface":
+        src = arcface_src * image_size / 112
     else:
         src = src_map * image_size / 112
-    for i in np.arange(src.shape[0]):
-        tform.estimate(lmk, src[i])
-        M = tform.params[0:2, :]
-        results = np.dot(M, lmk_tran.T)
-        results = results.T
-        error = np.sum(np.sqrt(np.sum((results - src[i]) ** 2, axis=1)))
-        if error < min_error:
-            min_error = error
-            min_M = M
-            min_index = i
-    return min_M, min_index
+
+    lmks = lmks.astype(np.float64)
+
+    # All faces against all templates at once: [F, T, 2, 3]
+    M = umeyama_batch(lmks[:, None], np.broadcast_to(src, (lmks.shape[0],) + src.shape))
+
+    results = lmks[:, None] @ np.swapaxes(M[..., :2], -1, -2) + M[..., None, :, 2]
+    error = np.sum(np.sqrt(np.sum((results - src) ** 2, axis=-1)), axis=-1)
+
+    min_index = np.argmin(error, axis=1)
+
+    return M[np.arange(lmks.shape[0]), min_index], min_index
+
+
+# lmk is prediction; src is template
+def estimate_norm(lmk, image_size=112, mode="ffhq"):
+    assert lmk.shape == (5, 2)
+    M, index = estimate_norm_batch(lmk[None], image_size, mode)
+    return M[0], index[0]
 
 
 def norm_crop(img, landmark, image_size=112, mode="ffhq"):
@@ -146,6 +181,8 @@ def square_crop(im, S):
 
 
 def transform(data, center, output_size, scale, rotation):
+    from skimage import transform as skt
+
     scale_ratio = scale
     rot = float(rotation) * np.pi / 180.0
     # translation = (output_size/2-center[0]*scale_ratio, output_size/2-center[1]*scale_ratio)
@@ -162,28 +199,14 @@ def transform(data, center, output_size, scale, rotation):
 
 
 def trans_points2d(pts, M):
-    new_pts = np.zeros(shape=pts.shape, dtype=np.float32)
-    for i in range(pts.shape[0]):
-        pt = pts[i]
-        new_pt = np.array([pt[0], pt[1], 1.0], dtype=np.float32)
-        new_pt = np.dot(M, new_pt)
-        # print('new_pt', new_pt.shape, new_pt)
-        new_pts[i] = new_pt[0:2]
-
-    return new_pts
+    return (pts[:, :2] @ M[:, :2].T + M[:, 2]).astype(np.float32)
 
 
 def trans_points3d(pts, M):
     scale = np.sqrt(M[0][0] * M[0][0] + M[0][1] * M[0][1])
-    # print(scale)
-    new_pts = np.zeros(shape=pts.shape, dtype=np.float32)
-    for i in range(pts.shape[0]):
-        pt = pts[i]
-        new_pt = np.array([pt[0], pt[1], 1.0], dtype=np.float32)
-        new_pt = np.dot(M, new_pt)
-        # print('new_pt', new_pt.shape, new_pt)
-        new_pts[i][0:2] = new_pt[0:2]
-        new_pts[i][2] = pts[i][2] * scale
+    new_pts = np.empty(shape=pts.shape, dtype=np.float32)
+    new_pts[:, :2] = pts[:, :2] @ M[:, :2].T + M[:, 2]
+    new_pts[:, 2] = pts[:, 2] * scale
 
     return new_pts
 
@@ -228,13 +251,37 @@ def inverse_transform_batch(mat: torch.Tensor) -> torch.Tensor:
 
 
 def align_face(
-    img: np.ndarray, key_points: np.ndarray, crop_size: int, mode: str = "ffhq"
-) -> Tuple[Iterable[np.ndarray], Iterable[np.ndarray]]:
+    img: np.ndarray,
+    key_points: np.ndarray,
+    crop_size: int,
+    mode: str = "ffhq",
+    return_tensor: bool = False,
+) -> Tuple[Union[Iterable[np.ndarray], torch.Tensor], Iterable[np.ndarray]]:
+    """Warps every face to the reference key points.
+
+    With return_tensor=True the crops are warped straight into one uint8 [N, 3, H, W]
+    batch, so downstream networks only have to apply their own normalization.
+    """
+    transform_matrices, _ = estimate_norm_batch(key_points, crop_size, mode=mode)
+
+    if return_tensor:
+        align_imgs = np.empty(
+            (len(transform_matrices), crop_size, crop_size, img.shape[2]), dtype=np.uint8
+        )
+        for i, transform_matrix in enumerate(transform_matrices):
+            cv2.warpAffine(
+                img,
+                transform_matrix,
+                (crop_size, crop_size),
+                dst=align_imgs[i],
+                borderValue=0.0,
+            )
+
+        return torch.from_numpy(align_imgs).permute(0, 3, 1, 2), list(transform_matrices)
+
     align_imgs = []
     transforms = []
-    for i in range(key_points.shape[0]):
-        kps = key_points[i]
-        transform_matrix, _ = estimate_norm(kps, crop_size, mode=mode)
+    for transform_matrix in transform_matrices:
         align_img = cv2.warpAffine(
             img, transform_matrix, (crop_size, crop_size), borderValue=0.0
         )
@@ -246,8 +293,7 @@ def align_face(
 import cv2
 import numpy as np
 import torch
-from skimage import transform as skt
-from typing import Iterable, Tuple
+from typing import Iterable, Tuple, Union
 
 src1 = np.array(
     [
@@ -322,40 +368,76 @@ ffhq_src = np.array(
 ffhq_src = np.expand_dims(ffhq_src, axis=0)
 
 
-# arcface_src = np.array(
-#     [[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366],
-#      [41.5493, 92.3655], [70.7299, 92.2041]],
-#     dtype=np.float32)
+# Reference key points ArcFace was trained with (112x112 crops)
+arcface_src = np.array(
+    [[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366],
+     [41.5493, 92.3655], [70.7299, 92.2041]],
+    dtype=np.float32)
 
-# arcface_src = np.expand_dims(arcface_src, axis=0)
+arcface_src = np.expand_dims(arcface_src, axis=0)
 
 # In[66]:
 
 
-# lmk is prediction; src is template
-def estimate_norm(lmk, image_size=112, mode="ffhq"):
-    assert lmk.shape == (5, 2)
-    tform = skt.SimilarityTransform()
-    lmk_tran = np.insert(lmk, 2, values=np.ones(5), axis=1)
-    min_M = []
-    min_index = []
-    min_error = float("inf")
+def umeyama_batch(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """Estimates similarity transforms mapping 'src' points to 'dst' points.
+
+    Vectorized version of the Umeyama algorithm used by skimage.SimilarityTransform:
+    src, dst - [..., N, 2] point sets, returns [..., 2, 3] transformation matrices.
+    """
+    num = src.shape[-2]
+
+    src_mean = src.mean(axis=-2, keepdims=True)
+    dst_mean = dst.mean(axis=-2, keepdims=True)
+    src_demean = src - src_mean
+    dst_demean = dst - dst_mean
+
+    A = np.swapaxes(dst_demean, -1, -2) @ src_demean / num
+
+    d = np.ones(A.shape[:-2] + (2,), dtype=np.float64)
+    d[np.linalg.det(A) < 0, 1] = -1
+
+    U, S, V = np.linalg.svd(A)
+    R = U @ (d[..., None] * V)
+
+    scale = np.sum(S * d, axis=-1) / src_demean.var(axis=-2).sum(axis=-1)
+    R = R * scale[..., None, None]
+
+    t = dst_mean[..., 0, :] - (R @ src_mean[..., 0, :, None])[..., 0]
+
+    return np.concatenate([R, t[..., None]], axis=-1)
+
+
+def estimate_norm_batch(
+    lmks: np.ndarray, image_size: int = 112, mode: str = "ffhq"
+) -> Tuple[np.ndarray, np.ndarray]:
+    # lmks: [F, 5, 2] predictions, returns the best [F, 2, 3] transforms and template indices
+    assert lmks.ndim == 3 and lmks.shape[1:] == (5, 2)
     if mode == "ffhq":
-        # assert image_size == 112
         src = ffhq_src * image_size / 512
+    elif mode == "arcface":
+        src = arcface_src * image_size / 112
     else:
         src = src_map * image_size / 112
-    for i in np.arange(src.shape[0]):
-        tform.estimate(lmk, src[i])
-        M = tform.params[0:2, :]
-        results = np.dot(M, lmk_tran.T)
-        results = results.T
-        error = np.sum(np.sqrt(np.sum((results - src[i]) ** 2, axis=1)))
-        if error < min_error:
-            min_error = error
-            min_M = M
-            min_index = i
-    return min_M, min_index
+
+    lmks = lmks.astype(np.float64)
+
+    # All faces against all templates at once: [F, T, 2, 3]
+    M = umeyama_batch(lmks[:, None], np.broadcast_to(src, (lmks.shape[0],) + src.shape))
+
+    results = lmks[:, None] @ np.swapaxes(M[..., :2], -1, -2) + M[..., None, :, 2]
+    error = np.sum(np.sqrt(np.sum((results - src) ** 2, axis=-1)), axis=-1)
+
+    min_index = np.argmin(error, axis=1)
+
+    return M[np.arange(lmks.shape[0]), min_index], min_index
+
+
+# lmk is prediction; src is template
+def estimate_norm(lmk, image_size=112, mode="ffhq"):
+    assert lmk.shape == (5, 2)
+    M, index = estimate_norm_batch(lmk[None], image_size, mode)
+    return M[0], index[0]
 
 
 def norm_crop(img, landmark, image_size=112, mode="ffhq"):
@@ -391,6 +473,8 @@ def square_crop(im, S):
 
 
 def transform(data, center, output_size, scale, rotation):
+    from skimage import transform as skt
+
     scale_ratio = scale
     rot = float(rotation) * np.pi / 180.0
     # translation = (output_size/2-center[0]*scale_ratio, output_size/2-center[1]*scale_ratio)
@@ -407,28 +491,14 @@ def transform(data, center, output_size, scale, rotation):
 
 
 def trans_points2d(pts, M):
-    new_pts = np.zeros(shape=pts.shape, dtype=np.float32)
-    for i in range(pts.shape[0]):
-        pt = pts[i]
-        new_pt = np.array([pt[0], pt[1], 1.0], dtype=np.float32)
-        new_pt = np.dot(M, new_pt)
-        # print('new_pt', new_pt.shape, new_pt)
-        new_pts[i] = new_pt[0:2]
-
-    return new_pts
+    return (pts[:, :2] @ M[:, :2].T + M[:, 2]).astype(np.float32)
 
 
 def trans_points3d(pts, M):
     scale = np.sqrt(M[0][0] * M[0][0] + M[0][1] * M[0][1])
-    # print(scale)
-    new_pts = np.zeros(shape=pts.shape, dtype=np.float32)
-    for i in range(pts.shape[0]):
-        pt = pts[i]
-        new_pt = np.array([pt[0], pt[1], 1.0], dtype=np.float32)
-        new_pt = np.dot(M, new_pt)
-        # print('new_pt', new_pt.shape, new_pt)
-        new_pts[i][0:2] = new_pt[0:2]
-        new_pts[i][2] = pts[i][2] * scale
+    new_pts = np.empty(shape=pts.shape, dtype=np.float32)
+    new_pts[:, :2] = pts[:, :2] @ M[:, :2].T + M[:, 2]
+    new_pts[:, 2] = pts[:, 2] * scale
 
     return new_pts
 
@@ -473,13 +543,37 @@ def inverse_transform_batch(mat: torch.Tensor) -> torch.Tensor:
 
 
 def align_face(
-    img: np.ndarray, key_points: np.ndarray, crop_size: int, mode: str = "ffhq"
-) -> Tuple[Iterable[np.ndarray], Iterable[np.ndarray]]:
+    img: np.ndarray,
+    key_points: np.ndarray,
+    crop_size: int,
+    mode: str = "ffhq",
+    return_tensor: bool = False,
+) -> Tuple[Union[Iterable[np.ndarray], torch.Tensor], Iterable[np.ndarray]]:
+    """Warps every face to the reference key points.
+
+    With return_tensor=True the crops are warped straight into one uint8 [N, 3, H, W]
+    batch, so downstream networks only have to apply their own normalization.
+    """
+    transform_matrices, _ = estimate_norm_batch(key_points, crop_size, mode=mode)
+
+    if return_tensor:
+        align_imgs = np.empty(
+            (len(transform_matrices), crop_size, crop_size, img.shape[2]), dtype=np.uint8
+        )
+        for i, transform_matrix in enumerate(transform_matrices):
+            cv2.warpAffine(
+                img,
+                transform_matrix,
+                (crop_size, crop_size),
+                dst=align_imgs[i],
+                borderValue=0.0,
+            )
+
+        return torch.from_numpy(align_imgs).permute(0, 3, 1, 2), list(transform_matrices)
+
     align_imgs = []
     transforms = []
-    for i in range(key_points.shape[0]):
-        kps = key_points[i]
-        transform_matrix, _ = estimate_norm(kps, crop_size, mode=mode)
+    for transform_matrix in transform_matrices:
         align_img = cv2.warpAffine(
             img, transform_matrix, (crop_size, crop_size), borderValue=0.0
         )
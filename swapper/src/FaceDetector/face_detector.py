@@ -1,9 +1,16 @@
-from typing import NamedTuple, Optional, Tuple
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 
-from insightface.model_zoo import model_zoo
 import numpy as np
 from pathlib import Path
 
+from src.FaceDetector.scrfd import SCRFD, decode, letterbox_batch, letterbox_size, nms
+
+
+# The smallest face (in pixels on the detector input) SCRFD finds reliably
+MIN_DET_FACE_SIZE = 16
+# Candidates smaller than this on the detector input are re-detected at full resolution
+REFINE_DET_FACE_SIZE = 32
+
 
 class Detection(NamedTuple):
     bbox: Optional[np.ndarray]
@@ -11,6 +18,31 @@ class Detection(NamedTuple):
     key_points: Optional[np.ndarray]
 
 
+def round_up(value: float, base: int = 32) -> int:
+    return int(np.ceil(value / base) * base)
+
+
+def merge_regions(regions: np.ndarray) -> List[np.ndarray]:
+    # Greedily merges overlapping [x1, y1, x2, y2] regions, so close candidates share a tile
+    merged = []
+    for region in regions[np.argsort(regions[:, 0])]:
+        for i, other in enumerate(merged):
+            if (
+                region[0] <= other[2]
+                and other[0] <= region[2]
+                and region[1] <= other[3]
+                and other[1] <= region[3]
+            ):
+                merged[i] = np.concatenate(
+                    [np.minimum(region[:2], other[:2]), np.maximum(region[2:], other[2:])]
+                )
+                break
+        else:
+            merged.append(region.copy())
+
+    return merged
+
+
 class FaceDetector:
     def __init__(
         self,
@@ -19,29 +51,213 @@ class FaceDetector:
         det_size: Tuple[int, int] = (640, 640),
         mode: str = "None",
         device: str = "cpu",
+        adaptive_det_size: bool = False,
+        min_face_size: int = 32,
+        min_det_size: int = 320,
+        max_det_size: int = 1280,
+        refine_small_faces: bool = False,
+        candidate_thresh: float = 0.3,
+        backend: str = "insightface",
+        num_threads: int = 0,
+        graph_optimization_level: str = "all",
     ):
         self.det_thresh = det_thresh
+        self.det_size = det_size
         self.mode = mode
         self.device = device
-        self.handler = model_zoo.get_model(str(model_path))
-        ctx_id = -1 if device == "cpu" else 0
-        self.handler.prepare(ctx_id, input_size=det_size)
+        self.adaptive_det_size = adaptive_det_size
+        self.min_face_size = min_face_size
+        self.min_det_size = min_det_size
+        self.max_det_size = max_det_size
+        self.refine_small_faces = refine_small_faces
+        self.candidate_thresh = min(candidate_thresh, det_thresh)
 
-    def __call__(self, img: np.ndarray, max_num: int = 0) -> Detection:
-        bboxes, kpss = self.handler.detect(
-            img, threshold=self.det_thresh, max_num=max_num, metric="default"
+        if backend == "native":
+            self.handler = SCRFD(
+                model_path,
+                device=device,
+                intra_op_num_threads=num_threads,
+                graph_optimization_level=graph_optimization_level,
+            )
+        elif backend == "insightface":
+            from insightface.model_zoo import model_zoo
+
+            self.handler = model_zoo.get_model(str(model_path))
+            ctx_id = -1 if device == "cpu" else 0
+            self.handler.prepare(ctx_id, input_size=det_size)
+        else:
+            raise ValueError(f"Unknown face detector backend: '{backend}'")
+
+    def get_det_size(self, img_shape: Tuple[int, ...]) -> Tuple[int, int]:
+        """Picks the detector input size (width, height) for an image.
+
+        The long side is chosen so the smallest expected face ('min_face_size' pixels
+        on the original image) is still large enough for the detector, clipped to
+        [min_det_size, max_det_size] and never larger than the image itself.
+        """
+        if not self.adaptive_det_size:
+            return self.det_size
+
+        h, w = img_shape[:2]
+        long_side = max(h, w)
+
+        det_long_side = long_side * MIN_DET_FACE_SIZE / self.min_face_size
+        det_long_side = min(det_long_side, self.max_det_size, round_up(long_side))
+        det_long_side = round_up(max(det_long_side, self.min_det_size))
+
+        return (
+            max(32, round_up(det_long_side * w / long_side)),
+            max(32, round_up(det_long_side * h / long_side)),
+        )
+
+    def detect(
+        self,
+        img: np.ndarray,
+        threshold: float,
+        det_size: Tuple[int, int],
+        max_num: int = 0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return self.handler.detect(
+            img,
+            threshold=threshold,
+            input_size=det_size,
+            max_num=max_num,
+            metric="default",
         )
+
+    def refine(
+        self, img: np.ndarray, bboxes: np.ndarray, kpss: np.ndarray, det_size: Tuple[int, int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # The scale of the letterbox the faces were detected in, whichever side limits it
+        _, _, det_scale = letterbox_size(img.shape, det_size)
+        face_sizes = np.minimum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1])
+
+        refine_ids = (bboxes[:, 4] < self.det_thresh) | (
+            face_sizes * det_scale < REFINE_DET_FACE_SIZE
+        )
+        if not np.any(refine_ids):
+            return bboxes, kpss
+
+        out_bboxes = [bboxes[~refine_ids]]
+        out_kpss = [kpss[~refine_ids]]
+
+        # Tiles are three face sizes wide around every candidate
+        centers = (bboxes[refine_ids, :2] + bboxes[refine_ids, 2:4]) / 2
+        half_sizes = np.maximum(1.5 * face_sizes[refine_ids], MIN_DET_FACE_SIZE * 2)[:, None]
+        regions = np.concatenate([centers - half_sizes, centers + half_sizes], axis=1)
+        regions = np.clip(regions, 0, [img.shape[1], img.shape[0]] * 2).astype(np.int64)
+
+        for x1, y1, x2, y2 in merge_regions(regions):
+            tile = img[y1:y2, x1:x2]
+            if tile.shape[0] < 2 or tile.shape[1] < 2:
+                continue
+
+            tile_long_side = min(round_up(max(tile.shape[:2])), self.max_det_size)
+            tile_scale = tile_long_side / max(tile.shape[:2])
+            tile_det_size = (
+                max(32, round_up(tile.shape[1] * tile_scale)),
+                max(32, round_up(tile.shape[0] * tile_scale)),
+            )
+
+            tile_bboxes, tile_kpss = self.detect(tile, self.det_thresh, tile_det_size)
+            if tile_bboxes.shape[0] == 0:
+                continue
+
+            # Map the tile detections back to the full resolution image
+            tile_bboxes[:, :4] += [x1, y1, x1, y1]
+            tile_kpss += [x1, y1]
+
+            out_bboxes.append(tile_bboxes)
+            out_kpss.append(tile_kpss)
+
+        bboxes = np.concatenate(out_bboxes, axis=0)
+        kpss = np.concatenate(out_kpss, axis=0)
+
+        keep = nms(bboxes)
+
+        return bboxes[keep], kpss[keep]
+
+    def __call__(self, img: np.ndarray, max_num: int = 0) -> Detection:
+        det_size = self.get_det_size(img.shape)
+
+        if self.refine_small_faces:
+            bboxes, kpss = self.detect(img, self.candidate_thresh, det_size)
+            if bboxes.shape[0] > 0:
+                bboxes, kpss = self.refine(img, bboxes, kpss, det_size)
+                keep = bboxes[:, 4] >= self.det_thresh
+                bboxes, kpss = bboxes[keep], kpss[keep]
+                if 0 < max_num < bboxes.shape[0]:
+                    bboxes, kpss = bboxes[:max_num], kpss[:max_num]
+        else:
+            bboxes, kpss = self.detect(img, self.det_thresh, det_size, max_num=max_num)
+
         if bboxes.shape[0] == 0:
             return Detection(None, None, None)
 
         return Detection(bboxes[..., :-1], bboxes[..., -1], kpss)
 
-from typing import NamedTuple, Optional, Tuple
+    def detect_batch(self, imgs: Iterable[np.ndarray], max_num: int = 0) -> List[Detection]:
+        """Detects faces on several images with a single session run.
+
+        All images are letterboxed into one input tensor, so the detector input size is
+        picked for the largest image. Falls back to per-image detection if the model was
+        exported with a fixed batch size.
+        """
+        imgs = list(imgs)
+        session = self.handler.session
+        input_cfg = session.get_inputs()[0]
+
+        batch_dim = input_cfg.shape[0]
+        if len(imgs) == 1 or (isinstance(batch_dim, int) and batch_dim != len(imgs)):
+            return [self(img, max_num=max_num) for img in imgs]
+
+        det_size = self.get_det_size(max((img.shape for img in imgs), key=lambda x: x[0] * x[1]))
+        blob, det_scales = letterbox_batch(imgs, det_size)
+
+        threshold = self.candidate_thresh if self.refine_small_faces else self.det_thresh
+        if isinstance(self.handler, SCRFD):
+            outputs = self.handler.run(blob)
+        else:
+            outputs = session.run(None, {input_cfg.name: blob})
+        if outputs[0].ndim != 3:
+            return [self(img, max_num=max_num) for img in imgs]
+
+        detections = []
+        for i, img in enumerate(imgs):
+            bboxes, kpss = decode([x[i] for x in outputs], det_size, det_scales[i], threshold)
+
+            if bboxes.shape[0] > 0:
+                keep = nms(bboxes)
+                bboxes, kpss = bboxes[keep], kpss[keep]
+
+            if self.refine_small_faces and bboxes.shape[0] > 0:
+                bboxes, kpss = self.refine(img, bboxes, kpss, det_size)
+                keep = bboxes[:, 4] >= self.det_thresh
+                bboxes, kpss = bboxes[keep], kpss[keep]
+
+            if 0 < max_num < bboxes.shape[0]:
+                bboxes, kpss = bboxes[:max_num], kpss[:max_num]
+
+            if bboxes.shape[0] == 0:
+                detections.append(Detection(None, None, None))
+            else:
+                detections.append(Detection(bboxes[..., :-1], bboxes[..., -1], kpss))
+
+        return detections
+
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 
-from insightface.model_zoo import model_zoo
 import numpy as np
 from pathlib import Path
 
+from src.FaceDetector.scrfd import SCRFD, decode, letterbox_batch, letterbox_size, nms
+
+
+# The smallest face (in pixels on the detector input) SCRFD finds reliably
+MIN_DET_FACE_SIZE = 16
+# Candidates smaller than this on the detector input are re-detected at full resolution
+REFINE_DET_FACE_SIZE = 32
+
 
 class Detection(NamedTuple):
     bbox: Optional[np.ndarray]
@@ -49,6 +265,31 @@ class Detection(NamedTuple):
     key_points: Optional[np.ndarray]
 
 
+def round_up(value: float, base: int = 32) -> int:
+    return int(np.ceil(value / base) * base)
+
+
+def merge_regions(regions: np.ndarray) -> List[np.ndarray]:
+    # Greedily merges overlapping [x1, y1, x2, y2] regions, so close candidates share a tile
+    merged = []
+    for region in regions[np.argsort(regions[:, 0])]:
+        for i, other in enumerate(merged):
+            if (
+                region[0] <= other[2]
+                and other[0] <= region[2]
+                and region[1] <= other[3]
+                and other[1] <= region[3]
+            ):
+                merged[i] = np.concatenate(
+                    [np.minimum(region[:2], other[:2]), np.maximum(region[2:], other[2:])]
+                )
+                break
+        else:
+            merged.append(region.copy())
+
+    return merged
+
+
 class FaceDetector:
     def __init__(
         self,
@@ -57,19 +298,196 @@ class FaceDetector:
         det_size: Tuple[int, int] = (640, 640),
         mode: str = "None",
         device: str = "cpu",
+        adaptive_det_size: bool = False,
+        min_face_size: int = 32,
+        min_det_size: int = 320,
+        max_det_size: int = 1280,
+        refine_small_faces: bool = False,
+        candidate_thresh: float = 0.3,
+        backend: str = "insightface",
+        num_threads: int = 0,
+        graph_optimization_level: str = "all",
     ):
         self.det_thresh = det_thresh
+        self.det_size = det_size
         self.mode = mode
         self.device = device
-        self.handler = model_zoo.get_model(str(model_path))
-        ctx_id = -1 if device == "cpu" else 0
-        self.handler.prepare(ctx_id, input_size=det_size)
+        self.adaptive_det_size = adaptive_det_size
+        self.min_face_size = min_face_size
+        self.min_det_size = min_det_size
+        self.max_det_size = max_det_size
+        self.refine_small_faces = refine_small_faces
+        self.candidate_thresh = min(candidate_thresh, det_thresh)
 
-    def __call__(self, img: np.ndarray, max_num: int = 0) -> Detection:
-        bboxes, kpss = self.handler.detect(
-            img, threshold=self.det_thresh, max_num=max_num, metric="default"
+        if backend == "native":
+            self.handler = SCRFD(
+                model_path,
+                device=device,
+                intra_op_num_threads=num_threads,
+                graph_optimization_level=graph_optimization_level,
+            )
+        elif backend == "insightface":
+            from insightface.model_zoo import model_zoo
+
+            self.handler = model_zoo.get_model(str(model_path))
+            ctx_id = -1 if device == "cpu" else 0
+            self.handler.prepare(ctx_id, input_size=det_size)
+        else:
+            raise ValueError(f"Unknown face detector backend: '{backend}'")
+
+    def get_det_size(self, img_shape: Tuple[int, ...]) -> Tuple[int, int]:
+        """Picks the detector input size (width, height) for an image.
+
+        The long side is chosen so the smallest expected face ('min_face_size' pixels
+        on the original image) is still large enough for the detector, clipped to
+        [min_det_size, max_det_size] and never larger than the image itself.
+        """
+        if not self.adaptive_det_size:
+            return self.det_size
+
+        h, w = img_shape[:2]
+        long_side = max(h, w)
+
+        det_long_side = long_side * MIN_DET_FACE_SIZE / self.min_face_size
+        det_long_side = min(det_long_side, self.max_det_size, round_up(long_side))
+        det_long_side = round_up(max(det_long_side, self.min_det_size))
+
+        return (
+            max(32, round_up(det_long_side * w / long_side)),
+            max(32, round_up(det_long_side * h / long_side)),
+        )
+
+    def detect(
+        self,
+        img: np.ndarray,
+        threshold: float,
+        det_size: Tuple[int, int],
+        max_num: int = 0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return self.handler.detect(
+            img,
+            threshold=threshold,
+            input_size=det_size,
+            max_num=max_num,
+            metric="default",
         )
+
+    def refine(
+        self, img: np.ndarray, bboxes: np.ndarray, kpss: np.ndarray, det_size: Tuple[int, int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # The scale of the letterbox the faces were detected in, whichever side limits it
+        _, _, det_scale = letterbox_size(img.shape, det_size)
+        face_sizes = np.minimum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1])
+
+        refine_ids = (bboxes[:, 4] < self.det_thresh) | (
+            face_sizes * det_scale < REFINE_DET_FACE_SIZE
+        )
+        if not np.any(refine_ids):
+            return bboxes, kpss
+
+        out_bboxes = [bboxes[~refine_ids]]
+        out_kpss = [kpss[~refine_ids]]
+
+        # Tiles are three face sizes wide around every candidate
+        centers = (bboxes[refine_ids, :2] + bboxes[refine_ids, 2:4]) / 2
+        half_sizes = np.maximum(1.5 * face_sizes[refine_ids], MIN_DET_FACE_SIZE * 2)[:, None]
+        regions = np.concatenate([centers - half_sizes, centers + half_sizes], axis=1)
+        regions = np.clip(regions, 0, [img.shape[1], img.shape[0]] * 2).astype(np.int64)
+
+        for x1, y1, x2, y2 in merge_regions(regions):
+            tile = img[y1:y2, x1:x2]
+            if tile.shape[0] < 2 or tile.shape[1] < 2:
+                continue
+
+            tile_long_side = min(round_up(max(tile.shape[:2])), self.max_det_size)
+            tile_scale = tile_long_side / max(tile.shape[:2])
+            tile_det_size = (
+                max(32, round_up(tile.shape[1] * tile_scale)),
+                max(32, round_up(tile.shape[0] * tile_scale)),
+            )
+
+            tile_bboxes, tile_kpss = self.detect(tile, self.det_thresh, tile_det_size)
+            if tile_bboxes.shape[0] == 0:
+                continue
+
+            # Map the tile detections back to the full resolution image
+            tile_bboxes[:, :4] += [x1, y1, x1, y1]
+            tile_kpss += [x1, y1]
+
+            out_bboxes.append(tile_bboxes)
+            out_kpss.append(tile_kpss)
+
+        bboxes = np.concatenate(out_bboxes, axis=0)
+        kpss = np.concatenate(out_kpss, axis=0)
+
+        keep = nms(bboxes)
+
+        return bboxes[keep], kpss[keep]
+
+    def __call__(self, img: np.ndarray, max_num: int = 0) -> Detection:
+        det_size = self.get_det_size(img.shape)
+
+        if self.refine_small_faces:
+            bboxes, kpss = self.detect(img, self.candidate_thresh, det_size)
+            if bboxes.shape[0] > 0:
+                bboxes, kpss = self.refine(img, bboxes, kpss, det_size)
+                keep = bboxes[:, 4] >= self.det_thresh
+                bboxes, kpss = bboxes[keep], kpss[keep]
+                if 0 < max_num < bboxes.shape[0]:
+                    bboxes, kpss = bboxes[:max_num], kpss[:max_num]
+        else:
+            bboxes, kpss = self.detect(img, self.det_thresh, det_size, max_num=max_num)
+
         if bboxes.shape[0] == 0:
             return Detection(None, None, None)
 
         return Detection(bboxes[..., :-1], bboxes[..., -1], kpss)
+
+    def detect_batch(self, imgs: Iterable[np.ndarray], max_num: int = 0) -> List[Detection]:
+        """Detects faces on several images with a single session run.
+
+        All images are letterboxed into one input tensor, so the detector input size is
+        picked for the largest image. Falls back to per-image detection if the model was
+        exported with a fixed batch size.
+        """
+        imgs = list(imgs)
+        session = self.handler.session
+        input_cfg = session.get_inputs()[0]
+
+        batch_dim = input_cfg.shape[0]
+        if len(imgs) == 1 or (isinstance(batch_dim, int) and batch_dim != len(imgs)):
+            return [self(img, max_num=max_num) for img in imgs]
+
+        det_size = self.get_det_size(max((img.shape for img in imgs), key=lambda x: x[0] * x[1]))
+        blob, det_scales = letterbox_batch(imgs, det_size)
+
+        threshold = self.candidate_thresh if self.refine_small_faces else self.det_thresh
+        if isinstance(self.handler, SCRFD):
+            outputs = self.handler.run(blob)
+        else:
+            outputs = session.run(None, {input_cfg.name: blob})
+        if outputs[0].ndim != 3:
+            return [self(img, max_num=max_num) for img in imgs]
+
+        detections = []
+        for i, img in enumerate(imgs):
+            bboxes, kpss = decode([x[i] for x in outputs], det_size, det_scales[i], threshold)
+
+            if bboxes.shape[0] > 0:
+                keep = nms(bboxes)
+                bboxes, kpss = bboxes[keep], kpss[keep]
+
+            if self.refine_small_faces and bboxes.shape[0] > 0:
+                bboxes, kpss = self.refine(img, bboxes, kpss, det_size)
+                keep = bboxes[:, 4] >= self.det_thresh
+                bboxes, kpss = bboxes[keep], kpss[keep]
+
+            if 0 < max_num < bboxes.shape[0]:
+                bboxes, kpss = bboxes[:max_num], kpss[:max_num]
+
+            if bboxes.shape[0] == 0:
+                detections.append(Detection(None, None, None))
+            else:
+                detections.append(Detection(bboxes[..., :-1], bboxes[..., -1], kpss))
+
+        return detections
@@ -0,0 +1,273 @@
+from functools import lru_cache
+import os
+from pathlib import Path
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+import onnxruntime
+
+
+# Same input normalization as the insightface SCRFD handler
+INPUT_MEAN = 127.5
+INPUT_STD = 128.0
+
+
+def letterbox_size(img_shape: Tuple[int, ...], det_size: Tuple[int, int]) -> Tuple[int, int, float]:
+    # The resized (width, height) of an image in a det_size letterbox and its scale
+    im_ratio = float(img_shape[0]) / img_shape[1]
+    model_ratio = float(det_size[1]) / det_size[0]
+    if im_ratio > model_ratio:
+        new_height = det_size[1]
+        new_width = int(new_height / im_ratio)
+    else:
+        new_width = det_size[0]
+        new_height = int(new_width * im_ratio)
+
+    return new_width, new_height, float(new_height) / img_shape[0]
+
+
+def letterbox(img: np.ndarray, det_size: Tuple[int, int]) -> Tuple[np.ndarray, float]:
+    # Resizes an image keeping its aspect ratio and pads it to det_size (width, height)
+    new_width, new_height, det_scale = letterbox_size(img.shape, det_size)
+    resized_img = cv2.resize(img, (new_width, new_height))
+    det_img = np.zeros((det_size[1], det_size[0], 3), dtype=np.uint8)
+    det_img[:new_height, :new_width, :] = resized_img
+
+    return det_img, det_scale
+
+
+def letterbox_batch(
+    imgs: Iterable[np.ndarray], det_size: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    det_imgs, det_scales = zip(*[letterbox(img, det_size) for img in imgs])
+
+    blob = cv2.dnn.blobFromImages(
+        list(det_imgs),
+        1.0 / INPUT_STD,
+        det_size,
+        (INPUT_MEAN, INPUT_MEAN, INPUT_MEAN),
+        swapRB=True,
+    )
+
+    return blob, np.array(det_scales, dtype=np.float32)
+
+
+@lru_cache(maxsize=32)
+def anchor_centers(
+    det_size: Tuple[int, int], strides: Tuple[int, ...], num_anchors: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Anchor centers of all FPN levels concatenated: [K, 2] and the stride of every anchor: [K, 1]
+    centers, anchor_strides = [], []
+    for stride in strides:
+        height, width = det_size[1] // stride, det_size[0] // stride
+        center = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+        center = (center * stride).reshape((-1, 2))
+        center = np.repeat(center, num_anchors, axis=0)
+        centers.append(center)
+        anchor_strides.append(np.full((center.shape[0], 1), stride, dtype=np.float32))
+
+    return np.concatenate(centers, axis=0), np.concatenate(anchor_strides, axis=0)
+
+
+def distance2bbox(points: np.ndarray, distance: np.ndarray) -> np.ndarray:
+    return np.concatenate([points - distance[..., :2], points + distance[..., 2:4]], axis=-1)
+
+
+def distance2kps(points: np.ndarray, distance: np.ndarray) -> np.ndarray:
+    return points[..., None, :] + distance.reshape(distance.shape[:-1] + (distance.shape[-1] // 2, 2))
+
+
+def nms(bboxes: np.ndarray, iou_thresh: float = 0.4) -> np.ndarray:
+    # bboxes: [N, 5] (x1, y1, x2, y2, score), returns indices of the kept boxes.
+    # The pairwise IoU matrix is computed once, only the greedy selection is sequential.
+    order = bboxes[:, 4].argsort()[::-1]
+    boxes = bboxes[order, :4]
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+
+    lt = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    rb = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    wh = np.maximum(0.0, rb - lt + 1)
+    inter = wh[..., 0] * wh[..., 1]
+    overlaps = inter / (areas[:, None] + areas[None, :] - inter) > iou_thresh
+
+    suppressed = np.zeros(boxes.shape[0], dtype=bool)
+    for i in range(boxes.shape[0]):
+        if not suppressed[i]:
+            suppressed[i + 1:] |= overlaps[i, i + 1:]
+
+    return order[~suppressed]
+
+
+def decode(
+    outputs: List[np.ndarray],
+    det_size: Tuple[int, int],
+    det_scale: float,
+    threshold: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Decodes the raw SCRFD outputs of one image.
+
+    'outputs' holds the scores, the box distances and the key point distances of
+    every FPN level (in this order, without the batch dimension). Returns boxes
+    [N, 5] (x1, y1, x2, y2, score) and key points [N, 5, 2] in the image coordinates.
+    """
+    # 6/9 outputs: 3 FPN levels without/with key points, 10/15 outputs: 5 FPN levels
+    fmc = 3 if len(outputs) in (6, 9) else 5
+    use_kps = len(outputs) == 3 * fmc
+    strides = (8, 16, 32, 64, 128)[:fmc]
+    num_anchors = outputs[0].shape[0] // ((det_size[1] // 8) * (det_size[0] // 8))
+
+    scores = np.concatenate(outputs[:fmc], axis=0)[:, 0]
+    pos = np.flatnonzero(scores >= threshold)
+
+    centers, anchor_strides = anchor_centers(det_size, strides, num_anchors)
+    centers, anchor_strides = centers[pos], anchor_strides[pos]
+
+    bbox_preds = np.concatenate(outputs[fmc: 2 * fmc], axis=0)[pos] * anchor_strides
+    bboxes = distance2bbox(centers, bbox_preds) / det_scale
+
+    if use_kps:
+        kps_preds = np.concatenate(outputs[2 * fmc:], axis=0)[pos] * anchor_strides
+        kpss = distance2kps(centers, kps_preds) / det_scale
+    else:
+        kpss = np.zeros((pos.shape[0], 5, 2), dtype=np.float32)
+
+    return np.hstack([bboxes, scores[pos, None]]).astype(np.float32), kpss.astype(np.float32)
+
+
+class SCRFD:
+    """SCRFD face detector running directly on onnxruntime.
+
+    Mirrors the 'detect' interface of the insightface handler, but gives control over
+    the session options, caches the optimized graph next to the model and reuses
+    preallocated output buffers (IO binding) for every input size it has seen.
+    """
+
+    GRAPH_OPTIMIZATION_LEVELS = {
+        "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        device: str = "cpu",
+        intra_op_num_threads: int = 0,
+        inter_op_num_threads: int = 0,
+        graph_optimization_level: str = "all",
+        cache_optimized_model: bool = True,
+        nms_thresh: float = 0.4,
+    ):
+        self.nms_thresh = nms_thresh
+
+        providers = ["CPUExecutionProvider"]
+        if str(device) != "cpu" and "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.intra_op_num_threads = intra_op_num_threads
+        sess_options.inter_op_num_threads = inter_op_num_threads
+        sess_options.graph_optimization_level = self.GRAPH_OPTIMIZATION_LEVELS[
+            graph_optimization_level
+        ]
+
+        model_path = Path(model_path)
+        save_path = None
+        if cache_optimized_model and graph_optimization_level != "disable":
+            # Optimized graphs may contain provider specific nodes, so the cache is per provider
+            optimized_path = model_path.with_name(
+                f"{model_path.stem}.{graph_optimization_level}.{providers[0]}.onnx"
+            )
+            if optimized_path.is_file():
+                model_path = optimized_path
+                sess_options.graph_optimization_level = self.GRAPH_OPTIMIZATION_LEVELS["disable"]
+            elif os.access(optimized_path.parent, os.W_OK):
+                # Saved aside and renamed, concurrent processes never load a partial graph.
+                # Without write access the graph is optimized on every start instead
+                save_path = optimized_path.with_name(f"{optimized_path.stem}.{os.getpid()}.tmp.onnx")
+                sess_options.optimized_model_filepath = str(save_path)
+
+        try:
+            self.session = onnxruntime.InferenceSession(
+                str(model_path), sess_options=sess_options, providers=providers
+            )
+        except Exception:
+            if save_path is None:
+                raise
+            # E.g. the disk is full, the session works without the cache
+            save_path.unlink(missing_ok=True)
+            save_path = None
+            sess_options.optimized_model_filepath = ""
+            self.session = onnxruntime.InferenceSession(
+                str(model_path), sess_options=sess_options, providers=providers
+            )
+
+        if save_path is not None:
+            try:
+                os.replace(save_path, optimized_path)
+            except OSError:
+                save_path.unlink(missing_ok=True)
+
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [x.name for x in self.session.get_outputs()]
+
+        self.bindings: Dict[Tuple[int, ...], Tuple[onnxruntime.IOBinding, List[np.ndarray]]] = {}
+        self.lock = threading.Lock()
+
+    def run(self, blob: np.ndarray) -> List[np.ndarray]:
+        blob = np.ascontiguousarray(blob, dtype=np.float32)
+
+        with self.lock:
+            if blob.shape not in self.bindings:
+                outputs = self.session.run(self.output_names, {self.input_name: blob})
+
+                # The output shapes are known now, preallocate buffers for this input size
+                binding = self.session.io_binding()
+                buffers = [np.empty_like(x) for x in outputs]
+                for name, buffer in zip(self.output_names, buffers):
+                    binding.bind_output(
+                        name, "cpu", 0, np.float32, list(buffer.shape), buffer.ctypes.data
+                    )
+                self.bindings[blob.shape] = (binding, buffers)
+
+                return outputs
+
+            binding, buffers = self.bindings[blob.shape]
+            binding.bind_cpu_input(self.input_name, blob)
+            self.session.run_with_iobinding(binding)
+
+            return [x.copy() for x in buffers]
+
+    def detect(
+        self,
+        img: np.ndarray,
+        threshold: float = 0.5,
+        input_size: Optional[Tuple[int, int]] = None,
+        max_num: int = 0,
+        metric: str = "default",
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        input_size = input_size if input_size is not None else (640, 640)
+
+        blob, det_scales = letterbox_batch([img], input_size)
+        outputs = self.run(blob)
+        if outputs[0].ndim == 3:
+            outputs = [x[0] for x in outputs]
+
+        bboxes, kpss = decode(outputs, input_size, det_scales[0], threshold)
+
+        keep = nms(bboxes, self.nms_thresh)
+        bboxes, kpss = bboxes[keep], kpss[keep]
+
+        if 0 < max_num < bboxes.shape[0]:
+            # The same selection as in insightface: big faces close to the image center first
+            area = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+            img_center = np.array([img.shape[1], img.shape[0]]) / 2
+            offsets = (bboxes[:, :2] + bboxes[:, 2:4]) / 2 - img_center
+            values = area if metric == "max" else area - np.sum(offsets ** 2, axis=1) * 2.0
+            keep = np.argsort(values)[::-1][:max_num]
+            bboxes, kpss = bboxes[keep], kpss[keep]
+
+        return bboxes, kpss
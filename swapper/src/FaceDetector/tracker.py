@@ -0,0 +1,171 @@
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+from src.FaceDetector.face_detector import Detection
+
+
+# Frames are compared on this small grayscale thumbnail to find scene changes
+SCENE_THUMBNAIL_SIZE = (64, 36)
+
+
+def iou_matrix(bboxes_a: np.ndarray, bboxes_b: np.ndarray) -> np.ndarray:
+    # Pairwise IoU of [N, 4] and [M, 4] (x1, y1, x2, y2) boxes: [N, M]
+    lt = np.maximum(bboxes_a[:, None, :2], bboxes_b[None, :, :2])
+    rb = np.minimum(bboxes_a[:, None, 2:4], bboxes_b[None, :, 2:4])
+    wh = np.maximum(0.0, rb - lt)
+    inter = wh[..., 0] * wh[..., 1]
+
+    area_a = (bboxes_a[:, 2] - bboxes_a[:, 0]) * (bboxes_a[:, 3] - bboxes_a[:, 1])
+    area_b = (bboxes_b[:, 2] - bboxes_b[:, 0]) * (bboxes_b[:, 3] - bboxes_b[:, 1])
+
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class FaceTracker:
+    """Tracks faces over consecutive video frames to avoid running the detector on every frame.
+
+    The detector runs every 'detect_interval' frames, on scene changes and whenever
+    tracking becomes unreliable. In between, the five key points of every face are
+    propagated with pyramidal Lucas-Kanade optical flow and checked by tracking them
+    back to the previous frame (forward-backward error). Detected faces are associated
+    with the existing tracks by IoU, so 'track_ids' stay stable over time.
+    """
+
+    def __init__(
+        self,
+        detector: Callable[[np.ndarray], Detection],
+        detect_interval: int = 5,
+        scene_change_threshold: float = 30.0,
+        max_fb_error: float = 0.05,
+        iou_threshold: float = 0.3,
+        flow_win_size: int = 21,
+        flow_max_level: int = 3,
+    ):
+        self.detector = detector
+        self.detect_interval = max(1, detect_interval)
+        # Mean absolute difference of the thumbnails (0..255) which is treated as a cut
+        self.scene_change_threshold = scene_change_threshold
+        # The forward-backward error allowed for a key point, relative to the face size
+        self.max_fb_error = max_fb_error
+        self.iou_threshold = iou_threshold
+        self.flow_params = dict(
+            winSize=(flow_win_size, flow_win_size),
+            maxLevel=flow_max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+        )
+
+        self.prev_gray: Optional[np.ndarray] = None
+        self.prev_thumbnail: Optional[np.ndarray] = None
+        self.detection = Detection(None, None, None)
+        self.track_ids: Optional[np.ndarray] = None
+        self.next_track_id = 0
+        self.frames_since_detection = 0
+        self.num_detections = 0
+        self.num_frames = 0
+
+    def reset(self) -> None:
+        self.prev_gray = None
+        self.prev_thumbnail = None
+        self.detection = Detection(None, None, None)
+        self.track_ids = None
+        self.frames_since_detection = 0
+
+    def is_scene_change(self, thumbnail: np.ndarray) -> bool:
+        if self.prev_thumbnail is None:
+            return True
+
+        diff = cv2.absdiff(thumbnail, self.prev_thumbnail)
+
+        return float(np.mean(diff)) > self.scene_change_threshold
+
+    def propagate(self, gray: np.ndarray) -> Optional[Detection]:
+        # Moves the key points of all tracks to the current frame, None if any face drifted
+        key_points = self.detection.key_points.astype(np.float32)
+        num_faces, num_points = key_points.shape[:2]
+        points = key_points.reshape(-1, 1, 2)
+
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.prev_gray, gray, points, None, **self.flow_params
+        )
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            gray, self.prev_gray, next_points, None, **self.flow_params
+        )
+
+        bboxes = self.detection.bbox
+        face_sizes = np.maximum(
+            np.minimum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]), 1.0
+        )
+
+        fb_error = np.linalg.norm(back_points - points, axis=-1).reshape(num_faces, num_points)
+        valid = (status.reshape(num_faces, num_points) == 1) & (
+            back_status.reshape(num_faces, num_points) == 1
+        )
+        if not np.all(valid) or np.any(fb_error > self.max_fb_error * face_sizes[:, None]):
+            return None
+
+        next_key_points = next_points.reshape(num_faces, num_points, 2)
+
+        # Boxes follow the similarity transform of their key points
+        next_bboxes = np.empty_like(bboxes)
+        for i in range(num_faces):
+            matrix, _ = cv2.estimateAffinePartial2D(key_points[i], next_key_points[i])
+            if matrix is None:
+                return None
+            corners = bboxes[i, :4].reshape(2, 2)
+            next_bboxes[i, :4] = (corners @ matrix[:, :2].T + matrix[:, 2]).reshape(-1)
+
+        return Detection(next_bboxes, self.detection.score, next_key_points)
+
+    def associate(self, detection: Detection) -> np.ndarray:
+        # Detected faces inherit the id of the best overlapping track, the rest get new ids
+        num_faces = detection.bbox.shape[0]
+        track_ids = np.full(num_faces, -1, dtype=np.int64)
+
+        if self.detection.bbox is not None:
+            ious = iou_matrix(detection.bbox, self.detection.bbox)
+            for flat_id in np.argsort(ious, axis=None)[::-1]:
+                i, j = np.unravel_index(flat_id, ious.shape)
+                if ious[i, j] < self.iou_threshold:
+                    break
+                if track_ids[i] < 0 and self.track_ids[j] not in track_ids:
+                    track_ids[i] = self.track_ids[j]
+
+        for i in np.flatnonzero(track_ids < 0):
+            track_ids[i] = self.next_track_id
+            self.next_track_id += 1
+
+        return track_ids
+
+    def __call__(self, img: np.ndarray) -> Detection:
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        thumbnail = cv2.resize(gray, SCENE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+        detection = None
+        if (
+            self.detection.bbox is not None
+            and self.frames_since_detection < self.detect_interval
+            and self.prev_gray.shape == gray.shape
+            and not self.is_scene_change(thumbnail)
+        ):
+            detection = self.propagate(gray)
+
+        if detection is None:
+            detection = self.detector(img)
+            self.num_detections += 1
+            self.frames_since_detection = 0
+            self.track_ids = None if detection.bbox is None else self.associate(detection)
+
+        self.frames_since_detection += 1
+        self.num_frames += 1
+        self.prev_gray = gray
+        self.prev_thumbnail = thumbnail
+        self.detection = detection
+
+        return detection
+
+    @property
+    def detection_ratio(self) -> float:
+        # The fraction of frames the detector actually ran on
+        return self.num_detections / max(self.num_frames, 1)
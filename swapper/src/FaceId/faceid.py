@@ -25,6 +25,13 @@ class FaceId(torch.nn.Module):
             ]
         )
 
+        self.register_buffer(
+            "mean", torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1), persistent=False
+        )
+        self.register_buffer(
+            "std", torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1), persistent=False
+        )
+
         for n, p in self.net.named_parameters():
             assert (
                 not p.requires_grad
@@ -34,9 +41,15 @@ class FaceId(torch.nn.Module):
         self.to(self.device)
 
     def forward(
-        self, img_id: Union[np.ndarray, Iterable[np.ndarray]], normalize: bool = True
+        self,
+        img_id: Union[np.ndarray, Iterable[np.ndarray], torch.Tensor],
+        normalize: bool = True,
     ) -> torch.Tensor:
-        if isinstance(img_id, Iterable):
+        if isinstance(img_id, torch.Tensor):
+            # uint8 [N, 3, H, W] batch of aligned crops
+            img_id = img_id.to(self.device, non_blocking=True).float().div_(255.0)
+            img_id = (img_id - self.mean) / self.std
+        elif isinstance(img_id, Iterable):
             img_id = [self.transform(x) for x in img_id]
             img_id = torch.stack(img_id, dim=0)
         else:
@@ -45,7 +58,11 @@ class FaceId(torch.nn.Module):
 
         img_id = img_id.to(self.device)
 
-        img_id_112 = F.interpolate(img_id, size=self.input_shape)
+        if tuple(img_id.shape[2:]) == tuple(self.input_shape):
+            # Already aligned straight to the ArcFace template
+            img_id_112 = img_id
+        else:
+            img_id_112 = F.interpolate(img_id, size=self.input_shape)
         latent_id = self.net(img_id_112)
         return F.normalize(latent_id, p=2, dim=1) if normalize else latent_id
 
@@ -76,6 +93,13 @@ class FaceId(torch.nn.Module):
             ]
         )
 
+        self.register_buffer(
+            "mean", torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1), persistent=False
+        )
+        self.register_buffer(
+            "std", torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1), persistent=False
+        )
+
         for n, p in self.net.named_parameters():
             assert (
                 not p.requires_grad
@@ -85,9 +109,15 @@ class FaceId(torch.nn.Module):
         self.to(self.device)
 
     def forward(
-        self, img_id: Union[np.ndarray, Iterable[np.ndarray]], normalize: bool = True
+        self,
+        img_id: Union[np.ndarray, Iterable[np.ndarray], torch.Tensor],
+        normalize: bool = True,
     ) -> torch.Tensor:
-        if isinstance(img_id, Iterable):
+        if isinstance(img_id, torch.Tensor):
+            # uint8 [N, 3, H, W] batch of aligned crops
+            img_id = img_id.to(self.device, non_blocking=True).float().div_(255.0)
+            img_id = (img_id - self.mean) / self.std
+        elif isinstance(img_id, Iterable):
             img_id = [self.transform(x) for x in img_id]
             img_id = torch.stack(img_id, dim=0)
         else:
@@ -96,6 +126,10 @@ class FaceId(torch.nn.Module):
 
         img_id = img_id.to(self.device)
 
-        img_id_112 = F.interpolate(img_id, size=self.input_shape)
+        if tuple(img_id.shape[2:]) == tuple(self.input_shape):
+            # Already aligned straight to the ArcFace template
+            img_id_112 = img_id
+        else:
+            img_id_112 = F.interpolate(img_id, size=self.input_shape)
         latent_id = self.net(img_id_112)
         return F.normalize(latent_id, p=2, dim=1) if normalize else latent_id
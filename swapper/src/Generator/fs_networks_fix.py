@@ -7,7 +7,7 @@ import torch
 import torch.nn as nn
 from torchvision import transforms
 
-from typing import Iterable
+from typing import Iterable, Union
 import numpy as np
 
 
@@ -117,8 +117,9 @@ class Generator_Adain_Upsample(nn.Module):
 
         self.to_tensor = transforms.Compose([transforms.ToTensor()])
 
-        self.imagenet_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
-        self.imagenet_std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        # Constants, not in the checkpoint: always real tensors, even if built on the meta device
+        self.imagenet_mean = torch.tensor([0.485, 0.456, 0.406], device="cpu").view(1, 3, 1, 1)
+        self.imagenet_std = torch.tensor([0.229, 0.224, 0.225], device="cpu").view(1, 3, 1, 1)
 
         self.first_layer = nn.Sequential(
             nn.ReflectionPad2d(3),
@@ -207,15 +208,21 @@ class Generator_Adain_Upsample(nn.Module):
         self.imagenet_std = self.imagenet_std.to(device)
         return self
 
-    def forward(self, x: Iterable[np.ndarray], dlatents: torch.Tensor):
-        if self.use_last_act:
-            x = [self.to_tensor(_) for _ in x]
+    def forward(self, x: Union[Iterable[np.ndarray], torch.Tensor], dlatents: torch.Tensor):
+        if isinstance(x, torch.Tensor):
+            # uint8 [N, 3, H, W] batch of aligned crops
+            x = x.to(self.device, non_blocking=True).float().div_(255.0)
+            if not self.use_last_act:
+                x = (x - self.imagenet_mean) / self.imagenet_std
         else:
-            x = [self.to_tensor_normalize(_) for _ in x]
+            if self.use_last_act:
+                x = [self.to_tensor(_) for _ in x]
+            else:
+                x = [self.to_tensor_normalize(_) for _ in x]
 
-        x = torch.stack(x, dim=0)
+            x = torch.stack(x, dim=0)
 
-        x = x.to(self.device)
+            x = x.to(self.device)
 
         skip1 = self.first_layer(x)
         skip2 = self.down1(skip1)
@@ -253,7 +260,7 @@ import torch
 import torch.nn as nn
 from torchvision import transforms
 
-from typing import Iterable
+from typing import Iterable, Union
 import numpy as np
 
 
@@ -363,8 +370,9 @@ class Generator_Adain_Upsample(nn.Module):
 
         self.to_tensor = transforms.Compose([transforms.ToTensor()])
 
-        self.imagenet_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
-        self.imagenet_std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        # Constants, not in the checkpoint: always real tensors, even if built on the meta device
+        self.imagenet_mean = torch.tensor([0.485, 0.456, 0.406], device="cpu").view(1, 3, 1, 1)
+        self.imagenet_std = torch.tensor([0.229, 0.224, 0.225], device="cpu").view(1, 3, 1, 1)
 
         self.first_layer = nn.Sequential(
             nn.ReflectionPad2d(3),
@@ -453,15 +461,21 @@ class Generator_Adain_Upsample(nn.Module):
         self.imagenet_std = self.imagenet_std.to(device)
         return self
 
-    def forward(self, x: Iterable[np.ndarray], dlatents: torch.Tensor):
-        if self.use_last_act:
-            x = [self.to_tensor(_) for _ in x]
+    def forward(self, x: Union[Iterable[np.ndarray], torch.Tensor], dlatents: torch.Tensor):
+        if isinstance(x, torch.Tensor):
+            # uint8 [N, 3, H, W] batch of aligned crops
+            x = x.to(self.device, non_blocking=True).float().div_(255.0)
+            if not self.use_last_act:
+                x = (x - self.imagenet_mean) / self.imagenet_std
         else:
-            x = [self.to_tensor_normalize(_) for _ in x]
+            if self.use_last_act:
+                x = [self.to_tensor(_) for _ in x]
+            else:
+                x = [self.to_tensor_normalize(_) for _ in x]
 
-        x = torch.stack(x, dim=0)
+            x = torch.stack(x, dim=0)
 
-        x = x.to(self.device)
+            x = x.to(self.device)
 
         skip1 = self.first_layer(x)
         skip2 = self.down1(skip1)
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import cv2
+from typing import Tuple
 
 
 def tensor2img_denorm(tensor):
@@ -27,9 +28,72 @@ def show_tensor(tensor, name):
     cv2.imshow(name, img)
     cv2.waitKey()
 
+
+def limited_size(width: int, height: int, max_megapixels: float) -> Tuple[int, int]:
+    # The (width, height) an image is downscaled to, to fit into max_megapixels (0 - no limit)
+    if max_megapixels <= 0 or height * width <= max_megapixels * 1e6:
+        return width, height
+
+    scale = np.sqrt(max_megapixels * 1e6 / (height * width))
+
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def limit_resolution(img: np.ndarray, max_megapixels: float) -> np.ndarray:
+    # Returns the same array if the image already fits
+    height, width = img.shape[:2]
+    size = limited_size(width, height, max_megapixels)
+    if size == (width, height):
+        return img
+
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def paste_face_region(original: np.ndarray, swapped: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Puts the swapped faces of a downscaled result into the full resolution original.
+
+    'mask' (HxW, 0..1) marks where 'swapped' differs from the downscaled original. Only the
+    region under the mask is upscaled, the rest of the original is left untouched.
+    """
+    ys, xs = np.nonzero(mask > 0)
+    if ys.shape[0] == 0:
+        return original
+
+    scale_y = original.shape[0] / swapped.shape[0]
+    scale_x = original.shape[1] / swapped.shape[1]
+
+    # The mask bounding box (plus a pixel for interpolation) in the original coordinates
+    x0 = max(0, int(np.floor((xs.min() - 1) * scale_x)))
+    y0 = max(0, int(np.floor((ys.min() - 1) * scale_y)))
+    x1 = min(original.shape[1], int(np.ceil((xs.max() + 2) * scale_x)))
+    y1 = min(original.shape[0], int(np.ceil((ys.max() + 2) * scale_y)))
+
+    # Maps the pixel centers of the region to the downscaled image (inverse map for warpAffine)
+    matrix = np.float32(
+        [
+            [1 / scale_x, 0, (x0 + 0.5) / scale_x - 0.5],
+            [0, 1 / scale_y, (y0 + 0.5) / scale_y - 0.5],
+        ]
+    )
+    flags = cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP
+    region_size = (x1 - x0, y1 - y0)
+    region = cv2.warpAffine(swapped, matrix, region_size, flags=flags, borderMode=cv2.BORDER_REPLICATE)
+    region_mask = cv2.warpAffine(
+        mask.astype(np.float32), matrix, region_size, flags=flags, borderMode=cv2.BORDER_REPLICATE
+    )
+    region_mask = np.clip(region_mask, 0.0, 1.0)[..., None]
+
+    result = original.copy()
+    result[y0:y1, x0:x1] = np.clip(
+        original[y0:y1, x0:x1] * (1.0 - region_mask) + region * region_mask, 0, 255
+    ).astype(np.uint8)
+
+    return result
+
 import torch
 import numpy as np
 import cv2
+from typing import Tuple
 
 
 def tensor2img_denorm(tensor):
@@ -55,3 +119,65 @@ def show_tensor(tensor, name):
     cv2.namedWindow(name, cv2.WINDOW_NORMAL)
     cv2.imshow(name, img)
     cv2.waitKey()
+
+
+def limited_size(width: int, height: int, max_megapixels: float) -> Tuple[int, int]:
+    # The (width, height) an image is downscaled to, to fit into max_megapixels (0 - no limit)
+    if max_megapixels <= 0 or height * width <= max_megapixels * 1e6:
+        return width, height
+
+    scale = np.sqrt(max_megapixels * 1e6 / (height * width))
+
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def limit_resolution(img: np.ndarray, max_megapixels: float) -> np.ndarray:
+    # Returns the same array if the image already fits
+    height, width = img.shape[:2]
+    size = limited_size(width, height, max_megapixels)
+    if size == (width, height):
+        return img
+
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def paste_face_region(original: np.ndarray, swapped: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Puts the swapped faces of a downscaled result into the full resolution original.
+
+    'mask' (HxW, 0..1) marks where 'swapped' differs from the downscaled original. Only the
+    region under the mask is upscaled, the rest of the original is left untouched.
+    """
+    ys, xs = np.nonzero(mask > 0)
+    if ys.shape[0] == 0:
+        return original
+
+    scale_y = original.shape[0] / swapped.shape[0]
+    scale_x = original.shape[1] / swapped.shape[1]
+
+    # The mask bounding box (plus a pixel for interpolation) in the original coordinates
+    x0 = max(0, int(np.floor((xs.min() - 1) * scale_x)))
+    y0 = max(0, int(np.floor((ys.min() - 1) * scale_y)))
+    x1 = min(original.shape[1], int(np.ceil((xs.max() + 2) * scale_x)))
+    y1 = min(original.shape[0], int(np.ceil((ys.max() + 2) * scale_y)))
+
+    # Maps the pixel centers of the region to the downscaled image (inverse map for warpAffine)
+    matrix = np.float32(
+        [
+            [1 / scale_x, 0, (x0 + 0.5) / scale_x - 0.5],
+            [0, 1 / scale_y, (y0 + 0.5) / scale_y - 0.5],
+        ]
+    )
+    flags = cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP
+    region_size = (x1 - x0, y1 - y0)
+    region = cv2.warpAffine(swapped, matrix, region_size, flags=flags, borderMode=cv2.BORDER_REPLICATE)
+    region_mask = cv2.warpAffine(
+        mask.astype(np.float32), matrix, region_size, flags=flags, borderMode=cv2.BORDER_REPLICATE
+    )
+    region_mask = np.clip(region_mask, 0.0, 1.0)[..., None]
+
+    result = original.copy()
+    result[y0:y1, x0:x1] = np.clip(
+        original[y0:y1, x0:x1] * (1.0 - region_mask) + region * region_mask, 0, 255
+    ).astype(np.uint8)
+
+    return result
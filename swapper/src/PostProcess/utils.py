@@ -25,7 +25,11 @@ class SoftErosion(torch.nn.Module):
         kernel = kernel.view(1, 1, *kernel.shape)
         self.register_buffer("weight", kernel)
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(
+        self, x: torch.Tensor, per_mask: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # With per_mask, every mask is normalized by its own maximum rather than the batch one,
+        # so it doesn't depend on the other masks in the batch
         for i in range(self.iterations - 1):
             x = torch.min(
                 x,
@@ -37,6 +41,12 @@ class SoftErosion(torch.nn.Module):
 
         mask = x >= self.threshold
 
+        if per_mask:
+            x_max = torch.where(mask, torch.zeros_like(x), x).amax(dim=(1, 2, 3), keepdim=True)
+            # add small epsilon to avoid Nans
+            x = torch.where(mask, torch.ones_like(x), x / (x_max + 1e-7))
+            return x, mask
+
         x[mask] = 1.0
         # add small epsilon to avoid Nans
         x[~mask] /= (x[~mask].max() + 1e-7)
@@ -148,7 +158,11 @@ class SoftErosion(torch.nn.Module):
         kernel = kernel.view(1, 1, *kernel.shape)
         self.register_buffer("weight", kernel)
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(
+        self, x: torch.Tensor, per_mask: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # With per_mask, every mask is normalized by its own maximum rather than the batch one,
+        # so it doesn't depend on the other masks in the batch
         for i in range(self.iterations - 1):
             x = torch.min(
                 x,
@@ -160,6 +174,12 @@ class SoftErosion(torch.nn.Module):
 
         mask = x >= self.threshold
 
+        if per_mask:
+            x_max = torch.where(mask, torch.zeros_like(x), x).amax(dim=(1, 2, 3), keepdim=True)
+            # add small epsilon to avoid Nans
+            x = torch.where(mask, torch.ones_like(x), x / (x_max + 1e-7))
+            return x, mask
+
         x[mask] = 1.0
         # add small epsilon to avoid Nans
         x[~mask] /= (x[~mask].max() + 1e-7)
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from src.DataManager.utils import imread_rgb_limited, imwrite_rgb
+from src.Runner import workers
+from src.simswap import SimSwap
+
+
+def read_manifest(manifest_path: Path) -> List[str]:
+    # One image path per line, relative paths are relative to the manifest, '#' starts a comment
+    with open(manifest_path) as f:
+        entries = [line.strip() for line in f]
+
+    return [x for x in entries if x and not x.startswith("#")]
+
+
+def in_shard(entry: str, shard_index: int, num_shards: int) -> bool:
+    # A hash of the path as written in the manifest is the same on every machine and run
+    # (unlike hash()), md5 rather than crc32 spreads similar names evenly over the shards
+    digest = hashlib.md5(entry.encode()).digest()
+    return int.from_bytes(digest[:8], "little") % num_shards == shard_index
+
+
+def process_item(input_path: Path, output_path: Path) -> Tuple[Path, Optional[str]]:
+    # Runs in a worker, returns the input and the error message (None on success)
+    pipeline = workers.worker_config.pipeline
+    max_megapixels = pipeline.max_megapixels
+    if pipeline.restore_full_resolution:
+        max_megapixels = 0
+
+    try:
+        output = workers.worker_model(imread_rgb_limited(input_path, max_megapixels))
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        # Written aside and renamed, an existing output is always complete (see pending_items).
+        # The suffix is kept, it selects the encoder
+        tmp_path = output_path.with_name(f".{output_path.stem}.{os.getpid()}.tmp{output_path.suffix}")
+        if not imwrite_rgb(tmp_path, output):
+            raise RuntimeError(f"Can't write {output_path}")
+        os.replace(tmp_path, output_path)
+    except Exception as e:
+        return input_path, str(e) or type(e).__name__
+
+    return input_path, None
+
+
+def _process_item(args: Tuple[Path, Path]) -> Tuple[Path, Optional[str]]:
+    # Pool.imap passes a single argument
+    return process_item(*args)
+
+
+class BulkImageJob:
+    """Swaps the images listed in a manifest, resumable and shardable across machines.
+
+    Every process (or node) runs shard 'shard_index' of 'num_shards': the items whose
+    path hash falls into it. Items with an existing output or marked as done in the
+    shard's status log (a JSON line per item) are skipped, so a crashed or stopped
+    run continues where it stopped. Failed items are retried on the next run.
+    """
+
+    def __init__(
+        self,
+        config,
+        manifest_path: Path,
+        output_dir: Path,
+        id_image: Optional[np.ndarray] = None,
+        multispecific_gallery: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None,
+        shard_index: int = 0,
+        num_shards: int = 1,
+        num_workers: int = 1,
+    ):
+        assert 0 <= shard_index < num_shards, "Shard index must be in [0, num_shards)!"
+
+        self.config = workers.resolve_config(config)
+        self.manifest_path = manifest_path
+        self.output_dir = output_dir
+        self.id_image = id_image
+        self.multispecific_gallery = multispecific_gallery
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.num_workers = max(1, num_workers)
+
+        self.status_path = output_dir / f"status_{shard_index}-of-{num_shards}.jsonl"
+
+    def output_path(self, input_path: Path) -> Path:
+        # The same layout as the manifest, output names as in ImageDataManager. Images outside
+        # the manifest directory go to a directory named after the hash of their own one
+        try:
+            relative_dir = input_path.parent.relative_to(self.manifest_path.parent)
+        except ValueError:
+            relative_dir = Path("external") / hashlib.md5(str(input_path.parent).encode()).hexdigest()[:16]
+
+        return self.output_dir / "img" / relative_dir / ("swap_" + input_path.name)
+
+    def read_status(self) -> Dict[str, str]:
+        status = {}
+        if self.status_path.is_file():
+            with open(self.status_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be cut off by a crash
+                        continue
+                    status[record["input"]] = record["status"]
+
+        return status
+
+    def pending_items(self) -> List[Path]:
+        status = self.read_status()
+
+        # Normalized, so 'a/../b.jpg' and 'b.jpg' are the same item; duplicates are dropped
+        items = list(
+            dict.fromkeys(
+                Path(os.path.normpath(self.manifest_path.parent / x))
+                for x in read_manifest(self.manifest_path)
+                if in_shard(x, self.shard_index, self.num_shards)
+            )
+        )
+
+        outputs: Dict[Path, Path] = {}
+        for item in items:
+            other = outputs.setdefault(self.output_path(item), item)
+            if other != item:
+                raise ValueError(f"{other} and {item} map to the same output {self.output_path(item)}")
+
+        return [
+            x
+            for x in items
+            if status.get(str(x)) != "done" and not self.output_path(x).is_file()
+        ]
+
+    def process(self, items: List[Path]) -> Iterator[Tuple[Path, Optional[str]]]:
+        if self.num_workers == 1:
+            # A single model, it computes the latents itself on the first image
+            model = SimSwap(
+                config=self.config.pipeline,
+                id_image=self.id_image,
+                multispecific_gallery=self.multispecific_gallery,
+            )
+            workers.init_worker(self.config, {}, self.multispecific_gallery, model=model)
+            for item in items:
+                yield process_item(item, self.output_path(item))
+            return
+
+        latents = workers.compute_latents(self.config, self.id_image, self.multispecific_gallery)
+
+        # CUDA can't be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            processes=self.num_workers,
+            initializer=workers.init_worker,
+            initargs=(self.config, latents, self.multispecific_gallery),
+        ) as pool:
+            yield from pool.imap_unordered(
+                _process_item, [(x, self.output_path(x)) for x in items]
+            )
+
+    def run(self) -> int:
+        # Returns the number of failed items
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        items = self.pending_items()
+        if not items:
+            return 0
+
+        num_failed = 0
+        with open(self.status_path, "a") as status_file:
+            for input_path, error in tqdm(self.process(items), total=len(items)):
+                record = {"input": str(input_path), "status": "done" if error is None else "failed"}
+                if error is None:
+                    record["output"] = str(self.output_path(input_path))
+                else:
+                    record["error"] = error
+                    num_failed += 1
+
+                # Written item by item, so nothing but the items in progress is lost on a crash
+                status_file.write(json.dumps(record) + "\n")
+                status_file.flush()
+
+        return num_failed
+
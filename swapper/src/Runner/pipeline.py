@@ -0,0 +1,209 @@
+import queue
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from src.DataManager.base import BaseDataManager
+
+
+# Marks the end of a stream in the queues
+_STOP = object()
+
+# Frames are compared on grayscale thumbnails of this size to find duplicates
+DUPLICATE_THUMBNAIL_SIZE = (160, 90)
+
+
+class PipelinedRunner:
+    """Runs frame decoding, face swapping and encoding concurrently.
+
+    A decoder thread reads frames from the data manager, 'num_workers' threads run the
+    model on them and the calling thread saves the results in the original order.
+    At most 'max_in_flight' frames (decoded, being swapped or waiting to be saved)
+    are held in memory at once, whatever the relative speed of the stages is.
+    With 'window_size' > 1 the workers get windows of consecutive frames and swap
+    them at once with 'model.swap_frames'.
+
+    With 'duplicate_threshold' > 0 frames which barely differ from the last swapped
+    frame (mean and max absolute difference of the thumbnails are below the
+    thresholds) are not swapped at all, the last swapped output is saved instead.
+    """
+
+    def __init__(
+        self,
+        model: Callable[[np.ndarray], np.ndarray],
+        data_manager: BaseDataManager,
+        num_workers: int = 1,
+        max_in_flight: int = 8,
+        window_size: int = 1,
+        duplicate_threshold: float = 0.0,
+        duplicate_max_diff: float = 16.0,
+    ):
+        self.model = model
+        self.data_manager = data_manager
+        self.num_workers = max(1, num_workers)
+        self.window_size = max(1, window_size)
+        # Every worker needs a window to process plus one waiting for it
+        self.max_in_flight = max(max_in_flight, 2 * self.num_workers * self.window_size)
+
+        self.duplicate_threshold = duplicate_threshold
+        self.duplicate_max_diff = duplicate_max_diff
+        self.reference_thumbnail: Optional[np.ndarray] = None
+        self.num_frames = 0
+        self.num_skipped = 0
+
+        self.in_queue: queue.Queue = queue.Queue()
+        self.out_queue: queue.Queue = queue.Queue()
+        self.slots = threading.Semaphore(self.max_in_flight)
+        self.stop_event = threading.Event()
+        self.errors: List[BaseException] = []
+
+    def fail(self, error: BaseException) -> None:
+        self.errors.append(error)
+        self.stop_event.set()
+
+    def is_duplicate(self, img: np.ndarray) -> bool:
+        # Compares against the last frame which was swapped, so a slow drift isn't skipped forever
+        if self.duplicate_threshold <= 0:
+            return False
+
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        thumbnail = cv2.resize(gray, DUPLICATE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+        if self.reference_thumbnail is not None and self.reference_thumbnail.shape == thumbnail.shape:
+            diff = cv2.absdiff(thumbnail, self.reference_thumbnail)
+            if np.mean(diff) < self.duplicate_threshold and np.max(diff) < self.duplicate_max_diff:
+                return True
+
+        self.reference_thumbnail = thumbnail
+
+        return False
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.num_skipped / max(self.num_frames, 1)
+
+    def decode(self) -> None:
+        try:
+            seq = 0
+            idxs, imgs = [], []
+            for _ in range(len(self.data_manager)):
+                # Waits for a free slot, but gives up as soon as some other stage failed
+                while not self.slots.acquire(timeout=0.1):
+                    if self.stop_event.is_set():
+                        return
+                if self.stop_event.is_set():
+                    return
+
+                img = self.data_manager.get()
+                if img is None:
+                    self.slots.release()
+                    break
+
+                self.num_frames += 1
+                if self.is_duplicate(img):
+                    # Nothing to swap, the frame is saved with the previous output
+                    self.num_skipped += 1
+                    img = None
+
+                idxs.append(self.data_manager.last_idx)
+                imgs.append(img)
+                if len(imgs) == self.window_size:
+                    self.in_queue.put((seq, idxs, imgs))
+                    seq += 1
+                    idxs, imgs = [], []
+
+            if imgs:
+                self.in_queue.put((seq, idxs, imgs))
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for _ in range(self.num_workers):
+                self.in_queue.put(_STOP)
+
+    def infer(self) -> None:
+        try:
+            while True:
+                item = self.in_queue.get()
+                if item is _STOP or self.stop_event.is_set():
+                    break
+
+                seq, idxs, imgs = item
+                frames = [img for img in imgs if img is not None]
+                if self.window_size > 1 and frames:
+                    swapped = iter(self.model.swap_frames(frames))
+                else:
+                    swapped = (self.model(img) for img in frames)
+                # Skipped frames stay None, the encoder fills them in
+                outputs = [None if img is None else next(swapped) for img in imgs]
+                self.out_queue.put((seq, idxs, outputs))
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.out_queue.put(_STOP)
+
+    def encode(self, progress: Optional[tqdm] = None) -> None:
+        # Results come in any order, they wait here until all the previous frames are saved
+        pending: Dict[int, Tuple[List[int], List[Optional[np.ndarray]]]] = {}
+        last_output: Optional[np.ndarray] = None
+        next_seq = 0
+        finished_workers = 0
+
+        while finished_workers < self.num_workers:
+            item = self.out_queue.get()
+            if item is _STOP:
+                finished_workers += 1
+                continue
+            if self.stop_event.is_set():
+                continue
+
+            seq, idxs, outputs = item
+            pending[seq] = (idxs, outputs)
+
+            while next_seq in pending:
+                idxs, outputs = pending.pop(next_seq)
+                for idx, output in zip(idxs, outputs):
+                    if output is None:
+                        output = last_output
+                    self.data_manager.save(output, idx)
+                    last_output = output
+                    self.slots.release()
+
+                    if progress is not None:
+                        progress.update()
+                next_seq += 1
+
+    def run(self) -> None:
+        # The identity latents are shared by all the workers, compute them only once
+        if hasattr(self.model, "prepare_latents"):
+            self.model.prepare_latents()
+
+        threads = [threading.Thread(target=self.decode, daemon=True)] + [
+            threading.Thread(target=self.infer, daemon=True) for _ in range(self.num_workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            with tqdm(total=len(self.data_manager)) as progress:
+                self.encode(progress)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+
+            if hasattr(self.data_manager, "close"):
+                self.data_manager.close()
+
+        if self.errors:
+            raise self.errors[0]
+
+        if self.duplicate_threshold > 0:
+            print(
+                f"Skipped {self.num_skipped} of {self.num_frames} frames "
+                f"({self.skip_ratio:.1%}) as duplicates"
+            )
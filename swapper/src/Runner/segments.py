@@ -0,0 +1,174 @@
+import multiprocessing
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from src.DataManager.VideoDataManager import VideoDataManager
+from src.DataManager.ffmpeg_utils import get_ffmpeg_binary, mux_audio, video_only_path
+from src.Runner import workers
+from src.Runner.pipeline import PipelinedRunner
+
+
+def run_ffmpeg(args: List[str]) -> None:
+    proc = subprocess.run(
+        [get_ffmpeg_binary(), "-y", "-loglevel", "error"] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {proc.stderr.decode(errors='ignore')}")
+
+
+def split_video(src_video: Path, segments_dir: Path, segment_seconds: float) -> List[Path]:
+    # Stream copy cuts only at keyframes, so every segment starts with one and nothing is re-encoded
+    done_marker = segments_dir / "split.done"
+    if not done_marker.is_file():
+        segments_dir.mkdir(parents=True, exist_ok=True)
+        for old_segment in segments_dir.glob("segment_*.mp4"):
+            old_segment.unlink()
+
+        run_ffmpeg(
+            [
+                "-i", str(src_video),
+                "-map", "0:v:0",
+                "-c", "copy",
+                "-f", "segment",
+                "-segment_time", str(segment_seconds),
+                "-reset_timestamps", "1",
+                str(segments_dir / "segment_%05d.mp4"),
+            ]
+        )
+        done_marker.touch()
+
+    return sorted(segments_dir.glob("segment_*.mp4"))
+
+
+def concat_segments(segments: List[Path], src_video: Path, output_path: Path) -> None:
+    list_path = output_path.with_suffix(".txt")
+    with open(list_path, "w") as f:
+        for segment in segments:
+            f.write(f"file '{segment.resolve()}'\n")
+
+    # Both the video and the source audio are copied as is
+    run_ffmpeg(
+        [
+            "-f", "concat",
+            "-safe", "0",
+            "-i", str(list_path),
+            "-c", "copy",
+            str(video_only_path(output_path)),
+        ]
+    )
+    list_path.unlink()
+
+    mux_audio(video_only_path(output_path), src_video, output_path)
+    video_only_path(output_path).unlink()
+
+
+def process_segment(segment: Path, swapped_dir: Path) -> Path:
+    data, pipeline = workers.worker_config.data, workers.worker_config.pipeline
+    # A worker gets segments from anywhere in the video, nothing tracked may carry over
+    workers.worker_model.reset_tracking()
+
+    data_manager = VideoDataManager(
+        src_data=segment,
+        output_dir=swapped_dir,
+        streaming=True,
+        codec=data.video_codec,
+        crf=data.video_crf,
+        preset=data.video_preset,
+        threads=data.video_encoder_threads,
+        max_megapixels=0 if pipeline.restore_full_resolution else pipeline.max_megapixels,
+    )
+    PipelinedRunner(
+        workers.worker_model,
+        data_manager,
+        num_workers=1,
+        max_in_flight=pipeline.pipeline_max_in_flight,
+        window_size=pipeline.frame_window_size,
+        duplicate_threshold=pipeline.duplicate_frame_threshold,
+        duplicate_max_diff=pipeline.duplicate_frame_max_diff,
+    ).run()
+
+    # The marker is written last, a segment without it is redone on resume
+    (swapped_dir / (segment.name + ".done")).touch()
+
+    return swapped_dir / data_manager.video_name
+
+
+class SegmentedVideoJob:
+    """Swaps a video in independent keyframe-aligned segments, in several processes.
+
+    The job keeps its state in 'output_dir/<video name>_job': source segments, swapped
+    segments and a '.done' marker per finished segment. Running the same job again
+    after an interruption only processes the segments without a marker. The swapped
+    segments are concatenated without re-encoding, the audio comes from the source.
+    """
+
+    def __init__(
+        self,
+        config,
+        src_video: Path,
+        output_dir: Path,
+        id_image: Optional[np.ndarray] = None,
+        multispecific_gallery: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None,
+        num_workers: int = 2,
+        segment_seconds: float = 10.0,
+    ):
+        self.config = workers.resolve_config(config)
+        self.src_video = src_video
+        self.output_dir = output_dir
+        self.id_image = id_image
+        self.multispecific_gallery = multispecific_gallery
+        self.num_workers = max(1, num_workers)
+        self.segment_seconds = segment_seconds
+
+        self.job_dir = output_dir / (src_video.stem + "_job")
+        self.segments_dir = self.job_dir / "segments"
+        self.swapped_dir = self.job_dir / "swapped"
+        self.output_path = output_dir / ("swap_" + src_video.name)
+
+    def compute_latents(self) -> Dict[str, Optional[torch.Tensor]]:
+        cached_path = self.job_dir / "latents.pt"
+        if cached_path.is_file():
+            return torch.load(cached_path)
+
+        latents = workers.compute_latents(self.config, self.id_image, self.multispecific_gallery)
+
+        # A resumed job keeps swapping with exactly the same identity
+        torch.save(latents, cached_path)
+
+        return latents
+
+    def pending_segments(self, segments: List[Path]) -> List[Path]:
+        return [x for x in segments if not (self.swapped_dir / (x.name + ".done")).is_file()]
+
+    def run(self) -> Path:
+        self.swapped_dir.mkdir(parents=True, exist_ok=True)
+
+        segments = split_video(self.src_video, self.segments_dir, self.segment_seconds)
+        assert len(segments), f"Can't split {self.src_video} into segments!"
+
+        pending = self.pending_segments(segments)
+        if pending:
+            latents = self.compute_latents()
+
+            # CUDA can't be used in forked processes
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(
+                processes=min(self.num_workers, len(pending)),
+                initializer=workers.init_worker,
+                initargs=(self.config, latents, self.multispecific_gallery),
+            ) as pool:
+                pool.starmap(process_segment, [(x, self.swapped_dir) for x in pending])
+
+        concat_segments(
+            [self.swapped_dir / ("swap_" + x.name) for x in segments],
+            self.src_video,
+            self.output_path,
+        )
+
+        return self.output_path
@@ -0,0 +1,54 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+from src.simswap import SimSwap
+
+
+# Identity latents computed once by a job and shared by all its worker processes
+LATENT_NAMES = ("id_latent", "specific_latent", "gallery_specific_latents", "gallery_id_latents")
+
+# The model and the config of a worker process, created once by 'init_worker'
+worker_model: Optional[SimSwap] = None
+worker_config = None
+
+
+def resolve_config(config: DictConfig) -> DictConfig:
+    # Spawned workers have no Hydra context to resolve '${hydra:...}' interpolations with
+    return OmegaConf.create(OmegaConf.to_container(config, resolve=True))
+
+
+def compute_latents(
+    config,
+    id_image: Optional[np.ndarray] = None,
+    multispecific_gallery: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None,
+) -> Dict[str, Optional[torch.Tensor]]:
+    model = SimSwap(config=config.pipeline, id_image=id_image, multispecific_gallery=multispecific_gallery)
+    model.prepare_latents()
+    latents = {
+        name: getattr(model, name).cpu() if getattr(model, name) is not None else None
+        for name in LATENT_NAMES
+    }
+    del model
+
+    return latents
+
+
+def init_worker(
+    config,
+    latents: Dict[str, Optional[torch.Tensor]],
+    multispecific_gallery,
+    model: Optional[SimSwap] = None,
+) -> None:
+    # 'model' is an already built model to use in the current process
+    global worker_model, worker_config
+
+    worker_config = config
+    worker_model = model
+    if worker_model is None:
+        worker_model = SimSwap(config=config.pipeline, multispecific_gallery=multispecific_gallery)
+    for name, latent in latents.items():
+        if latent is not None:
+            setattr(worker_model, name, latent.to(worker_model.device))
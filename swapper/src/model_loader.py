@@ -1,52 +1,116 @@
 from collections import namedtuple
+import hashlib
+import importlib
+import inspect
+import itertools
 import torch
-from torch.utils import model_zoo
+from torch.hub import download_url_to_file
 import requests
 from tqdm import tqdm
 from pathlib import Path
 
-from src.FaceDetector.face_detector import FaceDetector
-from src.FaceId.faceid import FaceId
-from src.Generator.fs_networks_fix import Generator_Adain_Upsample
-from src.PostProcess.ParsingModel.model import BiSeNet
-from src.PostProcess.GFPGAN.gfpgan import GFPGANer
-from src.Blend.blend import BlendModule
+from src.weight_cache import load_flat_weights, save_flat_weights
 
 
+# 'model' is the import path of the network class, its module is imported only
+# when the network is actually built
 model = namedtuple("model", ["url", "model"])
 
 models = {
     "face_detector": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/face_detector_scrfd_10g_bnkps.onnx",
-        model=FaceDetector,
+        model="src.FaceDetector.face_detector.FaceDetector",
     ),
     "arcface": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/arcface_net.jit",
-        model=FaceId,
+        model="src.FaceId.faceid.FaceId",
     ),
     "generator_224": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/simswap_224_latest_net_G.pth",
-        model=Generator_Adain_Upsample,
+        model="src.Generator.fs_networks_fix.Generator_Adain_Upsample",
     ),
     "generator_512": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/simswap_512_390000_net_G.pth",
-        model=Generator_Adain_Upsample,
+        model="src.Generator.fs_networks_fix.Generator_Adain_Upsample",
     ),
     "parsing_model": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/parsing_model_79999_iter.pth",
-        model=BiSeNet,
+        model="src.PostProcess.ParsingModel.model.BiSeNet",
     ),
     "gfpgan": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/v1.1/GFPGANv1.4_ema.pth",
-        model=GFPGANer,
+        model="src.PostProcess.GFPGAN.gfpgan.GFPGANer",
     ),
     "blend_module": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/v1.2/blend_module.jit",
-        model=BlendModule
+        model="src.Blend.blend.BlendModule"
     )
 }
 
 
+def get_model_class(model_name: str):
+    module_name, class_name = models[model_name].model.rsplit(".", 1)
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def has_meta_tensors(model: torch.nn.Module) -> bool:
+    # Parameters, buffers or plain tensor attributes created on the meta device have no data
+    for module in model.modules():
+        tensors = itertools.chain(
+            module.parameters(recurse=False),
+            module.buffers(recurse=False),
+            (x for x in vars(module).values() if isinstance(x, torch.Tensor)),
+        )
+        if any(x.is_meta for x in tensors):
+            return True
+
+    return False
+
+
+def supports_meta_loading() -> bool:
+    # Building on the meta device needs torch >= 2.0, load_state_dict(assign=True) torch >= 2.1
+    return "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def load_cached_weights(model_name: str, checkpoint_path: Path, cache_dir: Path, **kwargs):
+    """Builds a network on the memory-mapped weights of its flat cache, None if it can't.
+
+    The cache is written from the checkpoint on the first load and rebuilt when the
+    checkpoint's size or mtime changes (see weight_cache). The network is created on the
+    meta device (no memory, no random initialization; the device mode is per thread) and
+    its parameters are replaced by the mapped tensors, so nothing is read or copied until
+    the network is moved to the device or used. Older torch versions load the checkpoint
+    as is and no cache is written.
+    """
+    if not supports_meta_loading():
+        return None
+
+    # Checkpoints with the same file name in different directories get their own caches
+    path_hash = hashlib.md5(str(checkpoint_path.resolve()).encode()).hexdigest()[:8]
+    cache_path = cache_dir / f"{checkpoint_path.name}.{path_hash}.flat"
+    try:
+        state_dict = load_flat_weights(cache_path, checkpoint_path)
+        if state_dict is None:
+            cache_dir.mkdir(exist_ok=True)
+            save_flat_weights(torch.load(checkpoint_path, map_location="cpu"), cache_path, checkpoint_path)
+            state_dict = load_flat_weights(cache_path, checkpoint_path)
+
+        with torch.device("meta"):
+            model = get_model_class(model_name)(**kwargs)
+        model.load_state_dict(state_dict, assign=True)
+    except Exception as e:
+        print(f"Can't use the weight cache for '{model_name}', loading {checkpoint_path}: {e}")
+        return None
+
+    # E.g. non-persistent buffers, they aren't in the checkpoint
+    if has_meta_tensors(model):
+        print(f"Can't use the weight cache for '{model_name}', loading {checkpoint_path}")
+        return None
+
+    return model
+
+
 def get_model(
         model_name: str,
         device: torch.device,
@@ -60,19 +124,16 @@ def get_model(
     url = models[model_name].url if not model_path.is_file() else str(model_path)
 
     if load_state_dice:
-        model = models[model_name].model(**kwargs)
-
-        if Path(url).is_file():
-            state_dict = torch.load(url)
-        else:
-            state_dict = model_zoo.load_url(
-                url,
-                model_dir=str(dst_dir),
-                progress=True,
-                map_location="cpu",
-            )
+        checkpoint_path = Path(url)
+        if not checkpoint_path.is_file():
+            checkpoint_path = dst_dir / Path(url).name
+            if not checkpoint_path.is_file():
+                download_url_to_file(url, str(checkpoint_path), progress=True)
 
-        model.load_state_dict(state_dict)
+        model = load_cached_weights(model_name, checkpoint_path, dst_dir / "cache", **kwargs)
+        if model is None:
+            model = get_model_class(model_name)(**kwargs)
+            model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
 
         model.to(device)
         model.eval()
@@ -101,59 +162,123 @@ def get_model(
 
         kwargs.update({"model_path": str(dst_path), "device": device})
 
-        model = models[model_name].model(**kwargs)
+        model = get_model_class(model_name)(**kwargs)
 
     return model
 
 from collections import namedtuple
+import hashlib
+import importlib
+import inspect
+import itertools
 import torch
-from torch.utils import model_zoo
+from torch.hub import download_url_to_file
 import requests
 from tqdm import tqdm
 from pathlib import Path
 
-from src.FaceDetector.face_detector import FaceDetector
-from src.FaceId.faceid import FaceId
-from src.Generator.fs_networks_fix import Generator_Adain_Upsample
-from src.PostProcess.ParsingModel.model import BiSeNet
-from src.PostProcess.GFPGAN.gfpgan import GFPGANer
-from src.Blend.blend import BlendModule
+from src.weight_cache import load_flat_weights, save_flat_weights
 
 
+# 'model' is the import path of the network class, its module is imported only
+# when the network is actually built
 model = namedtuple("model", ["url", "model"])
 
 models = {
     "face_detector": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/face_detector_scrfd_10g_bnkps.onnx",
-        model=FaceDetector,
+        model="src.FaceDetector.face_detector.FaceDetector",
     ),
     "arcface": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/arcface_net.jit",
-        model=FaceId,
+        model="src.FaceId.faceid.FaceId",
     ),
     "generator_224": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/simswap_224_latest_net_G.pth",
-        model=Generator_Adain_Upsample,
+        model="src.Generator.fs_networks_fix.Generator_Adain_Upsample",
     ),
     "generator_512": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/simswap_512_390000_net_G.pth",
-        model=Generator_Adain_Upsample,
+        model="src.Generator.fs_networks_fix.Generator_Adain_Upsample",
     ),
     "parsing_model": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/weights/parsing_model_79999_iter.pth",
-        model=BiSeNet,
+        model="src.PostProcess.ParsingModel.model.BiSeNet",
     ),
     "gfpgan": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/v1.1/GFPGANv1.4_ema.pth",
-        model=GFPGANer,
+        model="src.PostProcess.GFPGAN.gfpgan.GFPGANer",
     ),
     "blend_module": model(
         url="https://github.com/mike9251/simswap-inference-pytorch/releases/download/v1.2/blend_module.jit",
-        model=BlendModule
+        model="src.Blend.blend.BlendModule"
     )
 }
 
 
+def get_model_class(model_name: str):
+    module_name, class_name = models[model_name].model.rsplit(".", 1)
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def has_meta_tensors(model: torch.nn.Module) -> bool:
+    # Parameters, buffers or plain tensor attributes created on the meta device have no data
+    for module in model.modules():
+        tensors = itertools.chain(
+            module.parameters(recurse=False),
+            module.buffers(recurse=False),
+            (x for x in vars(module).values() if isinstance(x, torch.Tensor)),
+        )
+        if any(x.is_meta for x in tensors):
+            return True
+
+    return False
+
+
+def supports_meta_loading() -> bool:
+    # Building on the meta device needs torch >= 2.0, load_state_dict(assign=True) torch >= 2.1
+    return "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def load_cached_weights(model_name: str, checkpoint_path: Path, cache_dir: Path, **kwargs):
+    """Builds a network on the memory-mapped weights of its flat cache, None if it can't.
+
+    The cache is written from the checkpoint on the first load and rebuilt when the
+    checkpoint's size or mtime changes (see weight_cache). The network is created on the
+    meta device (no memory, no random initialization; the device mode is per thread) and
+    its parameters are replaced by the mapped tensors, so nothing is read or copied until
+    the network is moved to the device or used. Older torch versions load the checkpoint
+    as is and no cache is written.
+    """
+    if not supports_meta_loading():
+        return None
+
+    # Checkpoints with the same file name in different directories get their own caches
+    path_hash = hashlib.md5(str(checkpoint_path.resolve()).encode()).hexdigest()[:8]
+    cache_path = cache_dir / f"{checkpoint_path.name}.{path_hash}.flat"
+    try:
+        state_dict = load_flat_weights(cache_path, checkpoint_path)
+        if state_dict is None:
+            cache_dir.mkdir(exist_ok=True)
+            save_flat_weights(torch.load(checkpoint_path, map_location="cpu"), cache_path, checkpoint_path)
+            state_dict = load_flat_weights(cache_path, checkpoint_path)
+
+        with torch.device("meta"):
+            model = get_model_class(model_name)(**kwargs)
+        model.load_state_dict(state_dict, assign=True)
+    except Exception as e:
+        print(f"Can't use the weight cache for '{model_name}', loading {checkpoint_path}: {e}")
+        return None
+
+    # E.g. non-persistent buffers, they aren't in the checkpoint
+    if has_meta_tensors(model):
+        print(f"Can't use the weight cache for '{model_name}', loading {checkpoint_path}")
+        return None
+
+    return model
+
+
 def get_model(
         model_name: str,
         device: torch.device,
@@ -167,19 +292,16 @@ def get_model(
     url = models[model_name].url if not model_path.is_file() else str(model_path)
 
     if load_state_dice:
-        model = models[model_name].model(**kwargs)
-
-        if Path(url).is_file():
-            state_dict = torch.load(url)
-        else:
-            state_dict = model_zoo.load_url(
-                url,
-                model_dir=str(dst_dir),
-                progress=True,
-                map_location="cpu",
-            )
+        checkpoint_path = Path(url)
+        if not checkpoint_path.is_file():
+            checkpoint_path = dst_dir / Path(url).name
+            if not checkpoint_path.is_file():
+                download_url_to_file(url, str(checkpoint_path), progress=True)
 
-        model.load_state_dict(state_dict)
+        model = load_cached_weights(model_name, checkpoint_path, dst_dir / "cache", **kwargs)
+        if model is None:
+            model = get_model_class(model_name)(**kwargs)
+            model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
 
         model.to(device)
         model.eval()
@@ -208,6 +330,6 @@ def get_model(
 
         kwargs.update({"model_path": str(dst_path), "device": device})
 
-        model = models[model_name].model(**kwargs)
+        model = get_model_class(model_name)(**kwargs)
 
     return model
@@ -1,18 +1,59 @@
 import numpy as np
+import threading
+import time
 import torch
 import torch.nn.functional as F
-from typing import Iterable, Tuple, Union
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 from pathlib import Path
 from torchvision import transforms
-import kornia
 from omegaconf import DictConfig
 
 from src.FaceDetector.face_detector import Detection
+from src.FaceDetector.tracker import FaceTracker
 from src.FaceAlign.face_align import align_face, inverse_transform_batch
 from src.PostProcess.utils import SoftErosion
 from src.model_loader import get_model
 from src.Misc.types import CheckpointType, FaceAlignmentType
-from src.Misc.utils import tensor2img
+from src.Misc.utils import limit_resolution, paste_face_region, tensor2img
+
+
+# Float32 values per pixel of the largest layer (input + output) of each network, measured on one
+# face. The generator works at the crop size, BiSeNet and GFPGAN resize the crops to 512x512
+GENERATOR_FLOATS_PER_PIXEL = 192
+PARSING_FLOATS_PER_PIXEL = 32
+ENHANCER_FLOATS_PER_PIXEL = 128
+PARSING_SIZE = 512
+ENHANCER_SIZE = 512
+
+
+class TrackIdentity(NamedTuple):
+    # Whether a tracked face is the specific person, confirmed by 'votes' frames in a row
+    is_match: bool
+    votes: int
+    distance: float
+
+
+class TrackMask(NamedTuple):
+    # Soft face mask of a tracked face in the aligned crop space, reused for several frames
+    soft_mask: Optional[torch.Tensor]
+    ignore: bool
+    # Small grayscale copy of the crop the mask was computed for
+    thumbnail: torch.Tensor
+    age: int
+    # Index of the face in the current batch whose mask is being computed, -1 once it's done
+    face_index: int
+
+
+class TemplateCache(NamedTuple):
+    # Everything about a template (attribute image) which doesn't depend on the source identity.
+    # The tensors stay on the CPU, cached templates don't hold device memory
+    att_image: np.ndarray
+    align_att_imgs: Optional[torch.Tensor]
+    att_transforms: List[np.ndarray]
+    soft_face_mask: Optional[torch.Tensor]
+    ignore_mask_ids: Optional[torch.Tensor]
+    # The full resolution template the faces are pasted back into, see 'restore_full_resolution'
+    full_image: Optional[np.ndarray] = None
 
 
 class SimSwap:
@@ -21,12 +62,26 @@ class SimSwap:
         config: DictConfig,
         id_image: Union[np.ndarray, None] = None,
         specific_image: Union[np.ndarray, None] = None,
+        multispecific_gallery: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None,
     ):
 
         self.id_image: Union[np.ndarray, None] = id_image
         self.id_latent: Union[torch.Tensor,  None] = None
         self.specific_id_image: Union[np.ndarray,  None] = specific_image
         self.specific_latent: Union[torch.Tensor,  None] = None
+        # Specific person decisions of the tracked faces (see FaceTracker), by track id
+        self.track_identities: Dict[int, TrackIdentity] = {}
+        self.track_identity_votes: int = getattr(config, "track_identity_votes", 3)
+        # Parsing masks of the tracked faces, recomputed every mask_reuse_interval frames
+        # or when the aligned crop changed more than mask_reuse_threshold (mean, 0-1)
+        self.track_masks: Dict[int, TrackMask] = {}
+        self.mask_reuse_interval: int = getattr(config, "mask_reuse_interval", 1)
+        self.mask_reuse_threshold: float = getattr(config, "mask_reuse_threshold", 0.05)
+
+        # Multi-specific mode: (specific person image, source identity image) pairs
+        self.multispecific_gallery: Optional[List[Tuple[np.ndarray, np.ndarray]]] = multispecific_gallery
+        self.gallery_specific_latents: Union[torch.Tensor,  None] = None
+        self.gallery_id_latents: Union[torch.Tensor,  None] = None
 
         self.use_mask: Union[bool, None] = True
         self.crop_size: Union[int, None] = None
@@ -37,6 +92,14 @@ class SimSwap:
         self.smooth_mask_threshold: Union[float,  None] = None
         self.face_detector_threshold: Union[float,  None] = None
         self.specific_latent_match_threshold: Union[float,  None] = None
+        self.face_batch_memory_mb: Union[float,  None] = None
+        # Upper limit on the faces processed at once (0 - only the memory budget applies)
+        self.max_faces_per_batch: int = getattr(config, "max_faces_per_batch", 0)
+        self.direct_id_alignment: bool = getattr(config, "direct_id_alignment", False)
+        # Working resolution cap in megapixels (0 - off), the swapped faces are optionally
+        # upscaled back into the full resolution input
+        self.max_megapixels: float = getattr(config, "max_megapixels", 0)
+        self.restore_full_resolution: bool = getattr(config, "restore_full_resolution", False)
         self.device = torch.device(config.device)
 
         self.set_parameters(config)
@@ -52,63 +115,156 @@ class SimSwap:
         # For SimSwap models trained with the updated code
         self.to_tensor = transforms.ToTensor()
 
-        self.face_detector = get_model(
-            "face_detector",
-            device=self.device,
-            load_state_dice=False,
-            model_path=Path(config.face_detector_weights),
-            det_thresh=self.face_detector_threshold,
-            det_size=(640, 640),
-            mode="ffhq",
-        )
+        # For batches of uint8 crops
+        self.imagenet_mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.imagenet_std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
 
-        self.face_id_net = get_model(
-            "arcface",
-            device=self.device,
-            load_state_dice=False,
-            model_path=Path(config.face_id_weights),
-        )
+        # Networks are built on their first use (see the properties below), so a worker is
+        # ready without loading e.g. GFPGAN if it never enhances anything
+        self.config = config
+        self.networks: Dict[str, torch.nn.Module] = {}
+        self.network_lock = threading.Lock()
+        self.load_times: Dict[str, float] = {}
 
-        self.bise_net = get_model(
-            "parsing_model",
-            device=self.device,
-            load_state_dice=True,
-            model_path=Path(config.parsing_model_weights),
-            n_classes=19,
-        )
+        # Video frames: run the detector every few frames and track the faces in between
+        self.face_tracker: Optional[FaceTracker] = None
+        if getattr(config, "track_faces", False):
+            self.face_tracker = FaceTracker(
+                # Doesn't build the detector before the first frame
+                lambda img: self.face_detector(img),
+                detect_interval=getattr(config, "track_detect_interval", 5),
+                scene_change_threshold=getattr(config, "track_scene_change_threshold", 30.0),
+                max_fb_error=getattr(config, "track_max_fb_error", 0.05),
+            )
 
-        gen_model = "generator_512" if self.crop_size == 512 else "generator_224"
-        self.simswap_net = get_model(
-            gen_model,
-            device=self.device,
-            load_state_dice=True,
-            model_path=Path(config.simswap_weights),
-            input_nc=3,
-            output_nc=3,
-            latent_size=512,
-            n_blocks=9,
-            deep=True if self.crop_size == 512 else False,
-            use_last_act=True
-            if self.checkpoint_type == CheckpointType.OFFICIAL_224
-            else False,
-        )
+        self.enhance_output = config.enhance_output
 
-        self.blend = get_model(
-            "blend_module",
-            device=self.device,
-            load_state_dice=False,
-            model_path=Path(config.blend_module_weights)
-        )
+    def get_network(self, name: str):
+        network = self.networks.get(name)
+        if network is None:
+            # Pipeline workers may ask for the same network at once
+            with self.network_lock:
+                if name not in self.networks:
+                    start_time = time.perf_counter()
+                    self.networks[name] = self.build_network(name)
+                    self.load_times[name] = time.perf_counter() - start_time
+                network = self.networks[name]
 
-        self.enhance_output = config.enhance_output
-        if config.enhance_output:
-            self.gfpgan_net = get_model(
+        return network
+
+    def build_network(self, name: str):
+        config = self.config
+
+        if name == "face_detector":
+            return get_model(
+                "face_detector",
+                device=self.device,
+                load_state_dice=False,
+                model_path=Path(config.face_detector_weights),
+                det_thresh=self.face_detector_threshold,
+                det_size=(640, 640),
+                mode="ffhq",
+                adaptive_det_size=getattr(config, "adaptive_det_size", False),
+                min_face_size=getattr(config, "min_face_size", 32),
+                refine_small_faces=getattr(config, "refine_small_faces", False),
+                backend=getattr(config, "face_detector_backend", "insightface"),
+                num_threads=getattr(config, "face_detector_threads", 0),
+            )
+
+        if name == "arcface":
+            return get_model(
+                "arcface",
+                device=self.device,
+                load_state_dice=False,
+                model_path=Path(config.face_id_weights),
+            )
+
+        if name == "parsing_model":
+            return get_model(
+                "parsing_model",
+                device=self.device,
+                load_state_dice=True,
+                model_path=Path(config.parsing_model_weights),
+                n_classes=19,
+                # The checkpoint has the backbone weights, ImageNet ones aren't downloaded
+                pretrained_backbone=False,
+            )
+
+        if name == "generator":
+            gen_model = "generator_512" if self.crop_size == 512 else "generator_224"
+            return get_model(
+                gen_model,
+                device=self.device,
+                load_state_dice=True,
+                model_path=Path(config.simswap_weights),
+                input_nc=3,
+                output_nc=3,
+                latent_size=512,
+                n_blocks=9,
+                deep=True if self.crop_size == 512 else False,
+                use_last_act=True
+                if self.checkpoint_type == CheckpointType.OFFICIAL_224
+                else False,
+            )
+
+        if name == "blend_module":
+            return get_model(
+                "blend_module",
+                device=self.device,
+                load_state_dice=False,
+                model_path=Path(config.blend_module_weights)
+            )
+
+        if name == "gfpgan":
+            return get_model(
                 "gfpgan",
                 device=self.device,
                 load_state_dice=True,
                 model_path=Path(config.gfpgan_weights)
             )
 
+        raise ValueError(f"Unknown network '{name}'!")
+
+    @property
+    def face_detector(self):
+        return self.get_network("face_detector")
+
+    @property
+    def face_id_net(self):
+        return self.get_network("arcface")
+
+    @property
+    def bise_net(self):
+        return self.get_network("parsing_model")
+
+    @property
+    def simswap_net(self):
+        return self.get_network("generator")
+
+    @property
+    def blend(self):
+        return self.get_network("blend_module")
+
+    @property
+    def gfpgan_net(self):
+        return self.get_network("gfpgan")
+
+    def load_report(self) -> str:
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.load_times.items())
+
+    def set_id_image(self, id_image: np.ndarray) -> None:
+        # A new source identity for __call__, its latent is computed on the next call
+        self.id_image = id_image
+        self.id_latent = None
+
+    def reset_tracking(self) -> None:
+        # Forgets the tracked faces and their cached identities and masks, e.g. before
+        # frames which don't follow the previous ones
+        if self.face_tracker is not None:
+            self.face_tracker.reset()
+        self.track_identities = {}
+        self.track_masks = {}
+
     def set_parameters(self, config) -> None:
         self.set_crop_size(config.crop_size)
         self.set_checkpoint_type(config.checkpoint_type)
@@ -118,6 +274,7 @@ class SimSwap:
         self.set_smooth_mask_kernel_size(config.smooth_mask_kernel_size)
         self.set_smooth_mask_threshold(config.smooth_mask_threshold)
         self.set_smooth_mask_iter(config.smooth_mask_iter)
+        self.set_face_batch_memory_mb(getattr(config, "face_batch_memory_mb", 1024))
 
     def set_crop_size(self, crop_size: int) -> None:
         if crop_size < 0:
@@ -156,6 +313,12 @@ class SimSwap:
 
         self.specific_latent_match_threshold = specific_latent_match_threshold
 
+    def set_face_batch_memory_mb(self, face_batch_memory_mb: float) -> None:
+        if face_batch_memory_mb <= 0:
+            raise "Invalid face_batch_memory_mb! Must be a positive value."
+
+        self.face_batch_memory_mb = face_batch_memory_mb
+
     def re_initialize_soft_mask(self):
         self.smooth_mask = SoftErosion(kernel_size=self.smooth_mask_kernel_size,
                                        threshold=self.smooth_mask_threshold,
@@ -180,126 +343,675 @@ class SimSwap:
         self.smooth_mask_iter = smooth_mask_iter
         self.re_initialize_soft_mask()
 
-    def run_detect_align(self, image: np.ndarray, for_id: bool = False) -> Tuple[Union[Iterable[np.ndarray], None],
-                                                                                 Union[Iterable[np.ndarray], None],
-                                                                                 np.ndarray]:
-        detection: Detection = self.face_detector(image)
+    def run_detect(self, image: np.ndarray, for_id: bool = False) -> Detection:
+        if not for_id and self.face_tracker is not None:
+            detection: Detection = self.face_tracker(image)
+        else:
+            detection: Detection = self.face_detector(image)
 
         if detection.bbox is None:
             if for_id:
                 raise ValueError("Can't detect a face! Please change the ID image!")
-            return None, None, detection.score
-
-        kps = detection.key_points
+            return detection
 
         if for_id:
             max_score_ind = np.argmax(detection.score, axis=0)
-            kps = detection.key_points[max_score_ind]
-            kps = kps[None, ...]
+            detection = Detection(
+                detection.bbox[max_score_ind][None, ...],
+                detection.score[max_score_ind][None, ...],
+                detection.key_points[max_score_ind][None, ...],
+            )
+
+        return detection
+
+    def run_align(
+        self, image: np.ndarray, key_points: np.ndarray, for_id: bool = False
+    ) -> Tuple[torch.Tensor, Iterable[np.ndarray]]:
+        if for_id and self.direct_id_alignment:
+            # Warp straight to the 112x112 ArcFace template instead of resizing crop_size crops
+            crop_size, mode = self.face_id_net.input_shape[0], "arcface"
+        else:
+            crop_size = self.crop_size
+            mode = "ffhq" if self.face_alignment_type == FaceAlignmentType.FFHQ else "none"
 
         align_imgs, transforms = align_face(
             image,
-            kps,
-            crop_size=self.crop_size,
-            mode="ffhq"
-            if self.face_alignment_type == FaceAlignmentType.FFHQ
-            else "none",
+            key_points,
+            crop_size=crop_size,
+            mode=mode,
+            return_tensor=True,
         )
 
+        # uint8 crops are moved to the device once and shared by all networks
+        align_imgs = align_imgs.to(self.device, non_blocking=True)
+
+        return align_imgs, transforms
+
+    def run_detect_align(self, image: np.ndarray, for_id: bool = False) -> Tuple[Union[torch.Tensor, None],
+                                                                                 Union[Iterable[np.ndarray], None],
+                                                                                 np.ndarray]:
+        detection = self.run_detect(image, for_id=for_id)
+
+        if detection.bbox is None:
+            return None, None, detection.score
+
+        align_imgs, transforms = self.run_align(image, detection.key_points, for_id=for_id)
+
         return align_imgs, transforms, detection.score
 
-    def __call__(self, att_image: np.ndarray) -> np.ndarray:
-        if self.id_latent is None:
-            align_id_imgs, id_transforms, _ = self.run_detect_align(
-                self.id_image, for_id=True
+    def get_latent(self, image: np.ndarray, normalize: bool) -> torch.Tensor:
+        align_imgs, _, _ = self.run_detect_align(image, for_id=True)
+        return self.face_id_net(align_imgs, normalize=normalize)
+
+    def init_gallery_latents(self) -> None:
+        # normalize=True for the source identities, the same as for the id_latent
+        self.gallery_specific_latents = torch.cat(
+            [self.get_latent(specific, normalize=False) for specific, _ in self.multispecific_gallery]
+        )
+        self.gallery_id_latents = torch.cat(
+            [self.get_latent(source, normalize=True) for _, source in self.multispecific_gallery]
+        )
+
+    def match_gallery(
+        self, att_latent: torch.Tensor, att_detection_score: np.ndarray
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Matches all target faces against all gallery faces at once.
+
+        Returns the indices of the matched target faces and the gallery index for each of them.
+        Like in the single specific person mode, every gallery person replaces at most one face.
+        """
+        # [N faces, K gallery persons]
+        latent_dist = torch.mean(
+            (att_latent[:, None, :] - self.gallery_specific_latents[None, :, :]) ** 2, dim=-1
+        )
+        weighted_dist = latent_dist * torch.tensor(
+            att_detection_score, device=latent_dist.device
+        )[:, None]
+
+        face_ids = torch.arange(latent_dist.shape[0], device=latent_dist.device)
+        gallery_ids = torch.argmin(weighted_dist, dim=1)
+        best_face_ids = torch.argmin(weighted_dist, dim=0)
+
+        matched = (latent_dist[face_ids, gallery_ids] < self.specific_latent_match_threshold) & (
+            best_face_ids[gallery_ids] == face_ids
+        )
+
+        return face_ids[matched], gallery_ids[matched]
+
+    def get_att_latent(
+        self, att_image: np.ndarray, key_points: np.ndarray, align_att_imgs: torch.Tensor
+    ) -> torch.Tensor:
+        if self.direct_id_alignment:
+            align_att_imgs, _ = self.run_align(att_image, key_points, for_id=True)
+
+        return self.face_id_net(align_att_imgs, normalize=False)
+
+    def get_specific_distances(
+        self, att_image: np.ndarray, att_detection: Detection, align_att_imgs: torch.Tensor
+    ) -> torch.Tensor:
+        """Distances between the target faces and the specific person latent.
+
+        Faces tracked over several frames reuse the distance once their decision
+        (match or not) was the same for 'track_identity_votes' frames in a row,
+        so ArcFace runs only for new or still uncertain tracks.
+        """
+        track_ids = self.face_tracker.track_ids if self.face_tracker is not None else None
+        if track_ids is None:
+            att_latent = self.get_att_latent(att_image, att_detection.key_points, align_att_imgs)
+            return self.specific_distance(att_latent)
+
+        # Lost tracks never come back, their ids are not reused
+        self.track_identities = {
+            track_id: identity
+            for track_id, identity in self.track_identities.items()
+            if track_id in track_ids
+        }
+
+        latent_dist = torch.empty(len(track_ids), device=self.device)
+
+        uncertain_ids = []
+        for i, track_id in enumerate(track_ids.tolist()):
+            identity = self.track_identities.get(track_id)
+            if identity is not None and identity.votes >= self.track_identity_votes:
+                latent_dist[i] = identity.distance
+            else:
+                uncertain_ids.append(i)
+
+        if uncertain_ids:
+            att_latent = self.get_att_latent(
+                att_image,
+                att_detection.key_points[uncertain_ids],
+                align_att_imgs[uncertain_ids],
             )
+            distances = self.specific_distance(att_latent)
+            latent_dist[uncertain_ids] = distances
+
+            for i, distance in zip(uncertain_ids, distances.tolist()):
+                track_id = int(track_ids[i])
+                is_match = distance < self.specific_latent_match_threshold
+                identity = self.track_identities.get(track_id)
+                votes = identity.votes + 1 if identity is not None and identity.is_match == is_match else 1
+                self.track_identities[track_id] = TrackIdentity(is_match, votes, distance)
+
+        return latent_dist
+
+    def specific_distance(self, att_latent: torch.Tensor) -> torch.Tensor:
+        return torch.mean(
+            F.mse_loss(
+                att_latent,
+                self.specific_latent.repeat(att_latent.shape[0], 1),
+                reduction="none",
+            ),
+            dim=-1,
+        )
+
+    def prepare_latents(self) -> None:
+        # Computes the identity latents once, call it before running the model from several threads
+        if self.multispecific_gallery is not None:
+            if self.gallery_id_latents is None:
+                self.init_gallery_latents()
+        elif self.id_latent is None:
             # normalize=True, because official SimSwap model trained with normalized id_lattent
-            self.id_latent: torch.Tensor = self.face_id_net(
-                align_id_imgs, normalize=True
-            )
+            self.id_latent: torch.Tensor = self.get_latent(self.id_image, normalize=True)
 
-        if self.specific_id_image is not None and self.specific_latent is None:
-            align_specific_imgs, specific_transforms, _ = self.run_detect_align(
-                self.specific_id_image, for_id=True
-            )
-            self.specific_latent: torch.Tensor = self.face_id_net(
-                align_specific_imgs, normalize=False
+        if (
+            self.multispecific_gallery is None
+            and self.specific_id_image is not None
+            and self.specific_latent is None
+        ):
+            self.specific_latent: torch.Tensor = self.get_latent(
+                self.specific_id_image, normalize=False
             )
 
-        # for_id=False, because we want to get all faces
-        align_att_imgs, att_transforms, att_detection_score = self.run_detect_align(
-            att_image, for_id=False
-        )
+    def __call__(self, att_image: np.ndarray) -> np.ndarray:
+        self.prepare_latents()
+
+        full_image = att_image
+        att_image = limit_resolution(att_image, self.max_megapixels)
+        restore = self.restore_full_resolution and att_image is not full_image
+
+        att_detection = self.run_detect(att_image, for_id=False)
+
+        selection = self.select_faces(att_image, att_detection)
+        if selection is None:
+            return full_image if restore else att_image
 
-        if not align_att_imgs or len(align_att_imgs) > 3:
+        if not restore:
+            return self.swap_faces(att_image, *selection)
+
+        swapped, face_mask = self.swap_faces(att_image, *selection, return_mask=True)
+
+        return paste_face_region(full_image, swapped, face_mask)
+
+    def select_faces(
+        self, att_image: np.ndarray, att_detection: Detection
+    ) -> Optional[
+        Tuple[torch.Tensor, List[np.ndarray], Optional[torch.Tensor], Optional[np.ndarray]]
+    ]:
+        # Aligned crops, their transforms, id latents and track ids of the faces to swap,
+        # None if there's none
+        if att_detection.bbox is None:
             raise ValueError("Bad image, change that please!")
 
+        align_att_imgs, att_transforms = self.run_align(att_image, att_detection.key_points)
+        att_detection_score = att_detection.score
 
-        if align_att_imgs is None and att_transforms is None:
-            return att_image
+        id_latents = None
+        track_ids = None
+        if self.face_tracker is not None and self.mask_reuse_interval > 1:
+            track_ids = self.face_tracker.track_ids
+            # Masks of lost tracks are never used again
+            self.track_masks = {
+                track_id: track_mask
+                for track_id, track_mask in self.track_masks.items()
+                if track_id in track_ids
+            }
 
-        # Select specific crop from the target image
-        if self.specific_latent is not None:
-            att_latent: torch.Tensor = self.face_id_net(align_att_imgs, normalize=False)
-            latent_dist = torch.mean(
-                F.mse_loss(
-                    att_latent,
-                    self.specific_latent.repeat(att_latent.shape[0], 1),
-                    reduction="none",
-                ),
-                dim=-1,
-            )
+        # Select specific crops from the target image
+        if self.multispecific_gallery is not None:
+            att_latent = self.get_att_latent(att_image, att_detection.key_points, align_att_imgs)
+            face_ids, gallery_ids = self.match_gallery(att_latent, att_detection_score)
+            if face_ids.shape[0] == 0:
+                return None
+
+            align_att_imgs = align_att_imgs[face_ids]
+            att_transforms = [att_transforms[i] for i in face_ids.tolist()]
+            if track_ids is not None:
+                track_ids = track_ids[face_ids.cpu().numpy()]
+            # Every face gets the latent of its own source identity
+            id_latents = self.gallery_id_latents[gallery_ids]
+
+        elif self.specific_latent is not None:
+            latent_dist = self.get_specific_distances(att_image, att_detection, align_att_imgs)
 
             att_detection_score = torch.tensor(
                 att_detection_score, device=latent_dist.device
             )
 
-            min_index = torch.argmin(latent_dist * att_detection_score)
+            min_index = int(torch.argmin(latent_dist * att_detection_score))
             min_value = latent_dist[min_index]
 
             if min_value < self.specific_latent_match_threshold:
-                align_att_imgs = [align_att_imgs[min_index]]
+                align_att_imgs = align_att_imgs[min_index: min_index + 1]
                 att_transforms = [att_transforms[min_index]]
+                if track_ids is not None:
+                    track_ids = track_ids[min_index: min_index + 1]
             else:
-                return att_image
+                return None
 
-        swapped_img: torch.Tensor = self.simswap_net(align_att_imgs, self.id_latent)
+        return align_att_imgs, list(att_transforms), id_latents, track_ids
 
-        if self.enhance_output:
-            swapped_img = self.gfpgan_net.enhance(swapped_img, weight=0.5)
+    @torch.no_grad()
+    def swap_frames(self, att_images: List[np.ndarray]) -> List[np.ndarray]:
+        """Swaps faces on a window of (consecutive) frames.
+
+        The crops of all frames are gathered, so every network runs on large batches
+        (up to the 'face_batch_memory_mb' budget), then the frames are composited one by one.
+        """
+        self.prepare_latents()
+
+        full_images = att_images
+        att_images = [limit_resolution(x, self.max_megapixels) for x in full_images]
+
+        # The tracker needs the frames one by one, otherwise all of them are detected at once
+        if self.face_tracker is None:
+            att_detections = self.face_detector.detect_batch(att_images)
+        else:
+            att_detections = [None] * len(att_images)
+
+        frame_selections = []
+        for i, att_image in enumerate(att_images):
+            att_detection = att_detections[i]
+            if att_detection is None:
+                att_detection = self.run_detect(att_image, for_id=False)
+            frame_selections.append(self.select_faces(att_image, att_detection))
+
+        selections = [x for x in frame_selections if x is not None]
+        if not selections:
+            return list(full_images if self.restore_full_resolution else att_images)
+
+        align_att_imgs = torch.cat([x[0] for x in selections])
+        id_latents = None
+        if any(x[2] is not None for x in selections):
+            id_latents = torch.cat(
+                [
+                    x[2] if x[2] is not None else self.id_latent.expand(x[0].shape[0], -1)
+                    for x in selections
+                ]
+            )
+        track_ids = None
+        if all(x[3] is not None for x in selections):
+            track_ids = np.concatenate([x[3] for x in selections])
+
+        # A batch mixes the faces of several frames, a face's mask must not depend on the others
+        batch_size = self.faces_per_batch()
+        swapped_imgs, soft_face_masks = [], []
+        for i in range(0, align_att_imgs.shape[0], batch_size):
+            swapped_img, soft_face_mask = self.generate(
+                align_att_imgs[i: i + batch_size],
+                id_latents[i: i + batch_size] if id_latents is not None else None,
+                track_ids[i: i + batch_size] if track_ids is not None else None,
+                per_mask=True,
+            )
+            swapped_imgs.append(swapped_img)
+            soft_face_masks.append(soft_face_mask)
+        swapped_imgs = torch.cat(swapped_imgs)
+        soft_face_masks = torch.cat(soft_face_masks)
+
+        results = []
+        face_offset = 0
+        for full_image, att_image, selection in zip(full_images, att_images, frame_selections):
+            restore = self.restore_full_resolution and att_image is not full_image
+            if selection is None:
+                results.append(full_image if restore else att_image)
+                continue
+
+            att_transforms = selection[1]
+            num_faces = len(att_transforms)
+            chunk_size = self.faces_per_chunk((att_image.shape[0], att_image.shape[1]))
+
+            result = self.to_tensor(att_image).to(self.device, non_blocking=True).unsqueeze(0)
+            face_mask = None
+            for i in range(0, num_faces, chunk_size):
+                face_ids = slice(face_offset + i, face_offset + min(i + chunk_size, num_faces))
+                result = self.composite(
+                    result,
+                    swapped_imgs[face_ids],
+                    soft_face_masks[face_ids],
+                    att_transforms[i: i + chunk_size],
+                    return_mask=restore,
+                )
+                if restore:
+                    result, chunk_mask = result
+                    face_mask = chunk_mask if face_mask is None else torch.maximum(face_mask, chunk_mask)
+
+            face_offset += num_faces
+            if restore:
+                results.append(
+                    paste_face_region(full_image, tensor2img(result), face_mask.cpu().numpy())
+                )
+            else:
+                results.append(tensor2img(result))
+
+        return results
+
+    def faces_per_chunk(self, frame_size: Tuple[int, int]) -> int:
+        # Rough peak memory needed per face: full-frame warped swap + mask (and the blend
+        # intermediates of the same size) plus crop-sized generator/enhancer/parsing activations.
+        frame_bytes = frame_size[0] * frame_size[1] * 4 * (3 + 1 + 3)
 
-        # Put all crops/transformations into a batch
-        align_att_img_batch_for_parsing_model: torch.Tensor = torch.stack(
-            [self.to_tensor_normalize(x) for x in align_att_imgs], dim=0
+        num_faces = int(self.face_batch_memory_mb * 2 ** 20) // (frame_bytes + self.crop_bytes())
+
+        return self.limit_faces(num_faces)
+
+    def crop_bytes(self) -> int:
+        # Rough peak memory of the crop-sized generator/enhancer/parsing activations per face
+        crop_bytes = 4 * (
+            self.crop_size * self.crop_size * GENERATOR_FLOATS_PER_PIXEL
+            + PARSING_SIZE * PARSING_SIZE * PARSING_FLOATS_PER_PIXEL
         )
-        align_att_img_batch_for_parsing_model = (
-            align_att_img_batch_for_parsing_model.to(self.device)
+        if self.enhance_output:
+            crop_bytes += 4 * ENHANCER_SIZE * ENHANCER_SIZE * ENHANCER_FLOATS_PER_PIXEL
+
+        return crop_bytes
+
+    def faces_per_batch(self) -> int:
+        # Network batch size when the crops are processed apart from compositing (see swap_frames)
+        return self.limit_faces(int(self.face_batch_memory_mb * 2 ** 20) // self.crop_bytes())
+
+    def limit_faces(self, num_faces: int) -> int:
+        if self.max_faces_per_batch > 0:
+            num_faces = min(num_faces, self.max_faces_per_batch)
+
+        return max(1, num_faces)
+
+    @torch.no_grad()
+    def swap_faces(
+        self,
+        att_image: np.ndarray,
+        align_att_imgs: torch.Tensor,
+        att_transforms: Iterable[np.ndarray],
+        id_latents: Optional[torch.Tensor] = None,
+        track_ids: Optional[np.ndarray] = None,
+        return_mask: bool = False,
+    ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        # With return_mask, also returns the union of the face masks in the frame (HxW, 0-1)
+        frame_size = (att_image.shape[0], att_image.shape[1])
+        chunk_size = self.faces_per_chunk(frame_size)
+
+        result = self.to_tensor(att_image).to(self.device, non_blocking=True).unsqueeze(0)
+        face_mask = torch.zeros(frame_size, device=self.device) if return_mask else None
+
+        # Faces are composited chunk after chunk, so the peak memory is bounded
+        # by the chunk size rather than by the number of faces on the image
+        for i in range(0, len(align_att_imgs), chunk_size):
+            result = self.swap_chunk(
+                result,
+                align_att_imgs[i: i + chunk_size],
+                att_transforms[i: i + chunk_size],
+                id_latents[i: i + chunk_size] if id_latents is not None else None,
+                track_ids[i: i + chunk_size] if track_ids is not None else None,
+                return_mask=return_mask,
+            )
+            if return_mask:
+                result, chunk_mask = result
+                face_mask = torch.maximum(face_mask, chunk_mask)
+
+        if return_mask:
+            return tensor2img(result), face_mask.cpu().numpy()
+
+        return tensor2img(result)
+
+    def swap_chunk(
+        self,
+        att_image: torch.Tensor,
+        align_att_imgs: torch.Tensor,
+        att_transforms: Iterable[np.ndarray],
+        id_latents: Optional[torch.Tensor] = None,
+        track_ids: Optional[np.ndarray] = None,
+        return_mask: bool = False,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        swapped_img, soft_face_mask = self.generate(align_att_imgs, id_latents, track_ids)
+
+        return self.composite(
+            att_image, swapped_img, soft_face_mask, att_transforms, return_mask=return_mask
         )
 
-        att_transforms: torch.Tensor = torch.stack(
-            [torch.tensor(x).float() for x in att_transforms], dim=0
+    def generate(
+        self,
+        align_att_imgs: torch.Tensor,
+        id_latents: Optional[torch.Tensor] = None,
+        track_ids: Optional[np.ndarray] = None,
+        per_mask: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Swapped crops and their soft face masks, both in the crop coordinates.
+        # 'per_mask' normalizes each soft mask on its own, see SoftErosion
+        swapped_img = self.run_generator(align_att_imgs, id_latents)
+
+        # Crops are already a uint8 batch, only the normalization differs per network
+        align_att_img_batch: torch.Tensor = align_att_imgs.to(self.device).float().div_(255.0)
+        align_att_img_batch_for_parsing_model: torch.Tensor = (
+            align_att_img_batch - self.imagenet_mean
+        ) / self.imagenet_std
+
+        if track_ids is None:
+            # Get face masks for the attribute image
+            face_mask, ignore_mask_ids = self.bise_net.get_mask(
+                align_att_img_batch_for_parsing_model, self.crop_size
+            )
+
+            soft_face_mask, _ = self.smooth_mask(face_mask, per_mask=per_mask)
+        else:
+            soft_face_mask, ignore_mask_ids = self.get_track_masks(
+                align_att_img_batch, align_att_img_batch_for_parsing_model, track_ids
+            )
+
+        swapped_img[ignore_mask_ids, ...] = align_att_img_batch[ignore_mask_ids, ...]
+
+        return swapped_img, soft_face_mask
+
+    def run_generator(
+        self, align_att_imgs: torch.Tensor, id_latents: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        # A single id_latent is broadcasted over the batch, otherwise there is a latent per face
+        id_latents = self.id_latent if id_latents is None else id_latents
+        swapped_img: torch.Tensor = self.simswap_net(align_att_imgs, id_latents)
+
+        if self.enhance_output:
+            swapped_img = self.gfpgan_net.enhance(swapped_img, weight=0.5)
+
+        return swapped_img
+
+    @torch.no_grad()
+    def precompute_template(self, att_image: np.ndarray) -> TemplateCache:
+        """Detects, aligns and parses the faces of a template once, for any number of sources."""
+        full_image = att_image
+        att_image = limit_resolution(att_image, self.max_megapixels)
+        if not self.restore_full_resolution or att_image is full_image:
+            full_image = None
+
+        # A template without faces (to swap) is returned as is
+        att_detection = self.run_detect(att_image, for_id=False)
+        if att_detection.bbox is None:
+            return TemplateCache(att_image, None, [], None, None, full_image)
+
+        selection = self.select_faces(att_image, att_detection)
+        if selection is None:
+            return TemplateCache(att_image, None, [], None, None, full_image)
+
+        align_att_imgs, att_transforms, _, _ = selection
+
+        soft_face_masks, ignore_mask_ids = [], []
+        batch_size = self.faces_per_batch()
+        for i in range(0, align_att_imgs.shape[0], batch_size):
+            align_att_img_batch = align_att_imgs[i: i + batch_size].float().div_(255.0)
+            face_mask, ignore_ids = self.bise_net.get_mask(
+                (align_att_img_batch - self.imagenet_mean) / self.imagenet_std, self.crop_size
+            )
+            soft_face_mask, _ = self.smooth_mask(face_mask)
+            soft_face_masks.append(soft_face_mask)
+            ignore_mask_ids.append(ignore_ids)
+
+        return TemplateCache(
+            att_image,
+            align_att_imgs.cpu(),
+            att_transforms,
+            torch.cat(soft_face_masks).cpu(),
+            torch.cat(ignore_mask_ids).cpu(),
+            full_image,
         )
-        att_transforms = att_transforms.to(self.device, non_blocking=True)
 
-        align_att_img_batch: torch.Tensor = torch.stack(
-            [self.to_tensor(x) for x in align_att_imgs], dim=0
+    @torch.no_grad()
+    def swap_templates(
+        self, id_image: np.ndarray, templates: List[TemplateCache]
+    ) -> List[np.ndarray]:
+        """Puts one source identity on many precomputed templates.
+
+        The id latent is computed once and the crops of all templates go through
+        the generator (and GFPGAN) in shared batches, only compositing is per template.
+        """
+        # normalize=True, because official SimSwap model trained with normalized id_lattent
+        id_latent = self.get_latent(id_image, normalize=True)
+
+        with_faces = [x for x in templates if x.align_att_imgs is not None]
+        if not with_faces:
+            return [x.att_image if x.full_image is None else x.full_image for x in templates]
+
+        align_att_imgs = torch.cat([x.align_att_imgs for x in with_faces]).to(self.device)
+        ignore_mask_ids = torch.cat([x.ignore_mask_ids for x in with_faces]).to(self.device)
+
+        batch_size = self.faces_per_batch()
+        swapped_imgs = torch.cat(
+            [
+                self.run_generator(align_att_imgs[i: i + batch_size], id_latent)
+                for i in range(0, align_att_imgs.shape[0], batch_size)
+            ]
         )
-        align_att_img_batch = align_att_img_batch.to(self.device, non_blocking=True)
+        swapped_imgs[ignore_mask_ids, ...] = align_att_imgs[ignore_mask_ids, ...].float() / 255.0
+
+        results = []
+        face_offset = 0
+        for template in templates:
+            if template.align_att_imgs is None:
+                results.append(template.att_image if template.full_image is None else template.full_image)
+                continue
 
-        # Get face masks for the attribute image
-        face_mask, ignore_mask_ids = self.bise_net.get_mask(
-            align_att_img_batch_for_parsing_model, self.crop_size
+            num_faces = len(template.att_transforms)
+            frame_size = (template.att_image.shape[0], template.att_image.shape[1])
+            chunk_size = self.faces_per_chunk(frame_size)
+            restore = template.full_image is not None
+
+            soft_face_mask = template.soft_face_mask.to(self.device)
+            result = self.to_tensor(template.att_image).to(self.device, non_blocking=True).unsqueeze(0)
+            face_mask = torch.zeros(frame_size, device=self.device) if restore else None
+            for i in range(0, num_faces, chunk_size):
+                result = self.composite(
+                    result,
+                    swapped_imgs[face_offset + i: face_offset + min(i + chunk_size, num_faces)],
+                    soft_face_mask[i: i + chunk_size],
+                    template.att_transforms[i: i + chunk_size],
+                    return_mask=restore,
+                )
+                if restore:
+                    result, chunk_mask = result
+                    face_mask = torch.maximum(face_mask, chunk_mask)
+
+            face_offset += num_faces
+            if restore:
+                results.append(
+                    paste_face_region(template.full_image, tensor2img(result), face_mask.cpu().numpy())
+                )
+            else:
+                results.append(tensor2img(result))
+
+        return results
+
+    def get_track_masks(
+        self,
+        align_att_img_batch: torch.Tensor,
+        align_att_img_batch_for_parsing_model: torch.Tensor,
+        track_ids: np.ndarray,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Soft face masks of tracked faces, reusing the masks of the previous frames.
+
+        The mask lives in the aligned crop space, so it stays valid while the crop looks the same.
+        BiSeNet runs only for the faces whose mask is older than 'mask_reuse_interval' frames
+        or whose crop differs from the one the mask was computed for by 'mask_reuse_threshold'.
+        """
+        thumbnails = F.interpolate(align_att_img_batch, size=(32, 32), mode="area").mean(dim=1)
+
+        # Decide first which faces need a new mask, a track may appear several times in a batch
+        refresh_ids = []
+        sources = []
+        for i, track_id in enumerate(track_ids.tolist()):
+            track_mask = self.track_masks.get(track_id)
+            if (
+                track_mask is None
+                or track_mask.age + 1 >= self.mask_reuse_interval
+                or float(torch.mean(torch.abs(thumbnails[i] - track_mask.thumbnail)))
+                > self.mask_reuse_threshold
+            ):
+                track_mask = TrackMask(None, False, thumbnails[i], 0, i)
+                refresh_ids.append(i)
+            else:
+                track_mask = track_mask._replace(age=track_mask.age + 1)
+
+            self.track_masks[track_id] = track_mask
+            sources.append(track_mask)
+
+        soft_face_mask = torch.empty(
+            (len(track_ids), 1, self.crop_size, self.crop_size), device=self.device
         )
+        ignore_mask_ids = torch.zeros(len(track_ids), dtype=torch.bool, device=self.device)
 
-        inv_att_transforms: torch.Tensor = inverse_transform_batch(att_transforms)
+        if refresh_ids:
+            face_mask, refresh_ignore_ids = self.bise_net.get_mask(
+                align_att_img_batch_for_parsing_model[refresh_ids], self.crop_size
+            )
+            refresh_soft_mask, _ = self.smooth_mask(face_mask)
+            soft_face_mask[refresh_ids] = refresh_soft_mask
+            ignore_mask_ids[refresh_ids] = refresh_ignore_ids
 
-        soft_face_mask, _ = self.smooth_mask(face_mask)
+        refresh_positions = {face_id: k for k, face_id in enumerate(refresh_ids)}
+        for i, track_mask in enumerate(sources):
+            if track_mask.soft_mask is not None:
+                soft_face_mask[i] = track_mask.soft_mask
+                ignore_mask_ids[i] = track_mask.ignore
+            elif track_mask.face_index != i:
+                # Computed in this batch for an earlier frame of the same track
+                soft_face_mask[i] = soft_face_mask[track_mask.face_index]
+                ignore_mask_ids[i] = ignore_mask_ids[track_mask.face_index]
 
-        swapped_img[ignore_mask_ids, ...] = align_att_img_batch[ignore_mask_ids, ...]
+        for track_id, track_mask in self.track_masks.items():
+            if track_mask.face_index in refresh_positions and track_mask.soft_mask is None:
+                face_id = track_mask.face_index
+                self.track_masks[track_id] = track_mask._replace(
+                    soft_mask=soft_face_mask[face_id].clone(),
+                    ignore=bool(ignore_mask_ids[face_id]),
+                    face_index=-1,
+                )
 
-        frame_size = (att_image.shape[0], att_image.shape[1])
+        return soft_face_mask, ignore_mask_ids
+
+    def composite(
+        self,
+        att_image: torch.Tensor,
+        swapped_img: torch.Tensor,
+        soft_face_mask: torch.Tensor,
+        att_transforms: Iterable[np.ndarray],
+        return_mask: bool = False,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        # Warps the swapped crops back to the frame and blends them in
+        import kornia  # Deferred, it's slow to import and unused until the first swap
+
+        att_transforms: torch.Tensor = torch.tensor(
+            np.asarray(att_transforms), dtype=torch.float32
+        )
+        att_transforms = att_transforms.to(self.device, non_blocking=True)
+
+        inv_att_transforms: torch.Tensor = inverse_transform_batch(att_transforms)
 
-        att_image = self.to_tensor(att_image).to(self.device, non_blocking=True).unsqueeze(0)
+        frame_size = (att_image.shape[2], att_image.shape[3])
 
         target_image = kornia.geometry.transform.warp_affine(
             swapped_img,
@@ -321,6 +1033,10 @@ class SimSwap:
             fill_value=torch.zeros(3),
         )
 
-        result = self.blend(target_image, soft_face_mask, att_image)
+        blended = self.blend(target_image, soft_face_mask, att_image)
 
-        return tensor2img(result)
+        if return_mask:
+            # The union of the warped masks, the area of the frame the faces changed
+            return blended, soft_face_mask.amax(dim=(0, 1))
+
+        return blended
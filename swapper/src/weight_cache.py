@@ -0,0 +1,96 @@
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+
+# File layout: 8 bytes header length (little-endian), a JSON header with the source checkpoint
+# stamp and the dtype/shape/offset of every tensor, then the raw tensors, each 64-byte aligned
+HEADER_SIZE_FORMAT = "<Q"
+ALIGNMENT = 64
+
+# Stored as is, bfloat16 has no numpy counterpart and is stored as int16 bits
+DTYPES = {
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.float64: np.float64,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.int16: np.int16,
+    torch.int8: np.int8,
+    torch.uint8: np.uint8,
+    torch.bool: np.bool_,
+}
+
+
+def source_stamp(source_path: Path) -> Dict[str, int]:
+    stat = source_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def save_flat_weights(state_dict: Dict[str, torch.Tensor], path: Path, source_path: Path) -> None:
+    tensors = {}
+    entries = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        dtype = str(tensor.dtype).replace("torch.", "")
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        elif tensor.dtype not in DTYPES:
+            raise TypeError(f"Can't cache '{name}' of type {tensor.dtype}")
+
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        entries[name] = {"dtype": dtype, "shape": list(tensor.shape), "offset": offset}
+        tensors[name] = tensor
+        offset += tensor.numel() * tensor.element_size()
+
+    header = json.dumps({"source": source_stamp(source_path), "tensors": entries}).encode()
+    # The data starts aligned too, offsets are relative to it
+    data_start = -(-(struct.calcsize(HEADER_SIZE_FORMAT) + len(header)) // ALIGNMENT) * ALIGNMENT
+    header += b" " * (data_start - struct.calcsize(HEADER_SIZE_FORMAT) - len(header))
+
+    # Written aside and renamed, so concurrent workers never see a partial file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(HEADER_SIZE_FORMAT, len(header)))
+        f.write(header)
+        for name, tensor in tensors.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(tensor.numpy().tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_flat_weights(path: Path, source_path: Path) -> Optional[Dict[str, torch.Tensor]]:
+    """Memory-maps the cached tensors, None if the cache is missing or outdated.
+
+    The tensors share the memory of the mapped file (copy-on-write), so nothing is read
+    until it's used and processes loading the same weights share the page cache.
+    """
+    if not path.is_file():
+        return None
+
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack(HEADER_SIZE_FORMAT, f.read(struct.calcsize(HEADER_SIZE_FORMAT)))
+        header = json.loads(f.read(header_size))
+
+    if header["source"] != source_stamp(source_path):
+        return None
+
+    data_start = struct.calcsize(HEADER_SIZE_FORMAT) + header_size
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start)
+
+    state_dict = {}
+    for name, entry in header["tensors"].items():
+        dtype = getattr(torch, entry["dtype"])
+        np_dtype = DTYPES[torch.int16 if dtype == torch.bfloat16 else dtype]
+        count = int(np.prod(entry["shape"]))
+        array = np.frombuffer(data, dtype=np_dtype, count=count, offset=entry["offset"])
+        tensor = torch.from_numpy(array).view(entry["shape"])
+        state_dict[name] = tensor.view(torch.bfloat16) if dtype == torch.bfloat16 else tensor
+
+    return state_dict
@@ -1,16 +1,29 @@
+import time
+
+# Measured from here, so the startup report includes the imports
+START_TIME = time.perf_counter()
+
 from collections import namedtuple
+from functools import lru_cache
 from fastapi import FastAPI, UploadFile, File, Form
 from PIL import Image
 from io import BytesIO
 import numpy as np
-from src.simswap import SimSwap
-from app import run_application
+from src.simswap import SimSwap, TemplateCache
+from src.DataManager.utils import imread_rgb, imread_rgb_limited, imwrite_rgb
 from pydantic import BaseModel
+from typing import List, Optional, Tuple
 import os
-from crop import watermark_adder
-from add_height import height_increaser, height_decrease
+from crop import save_watermarked
+from add_height import pad_height, remove_height_padding
 import uuid
-import shutil
+
+# The number of templates whose faces are kept in memory, see load_template
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", "64"))
+# Off by default. E.g. MAX_MEGAPIXELS=4 and RESTORE_FULL_RESOLUTION=1 swap phone photos (12-48 MP)
+# at 4 MP and paste the faces back into the full size, see 'max_megapixels' in configs/
+MAX_MEGAPIXELS = float(os.environ.get("MAX_MEGAPIXELS", "0"))
+RESTORE_FULL_RESOLUTION = os.environ.get("RESTORE_FULL_RESOLUTION", "0") == "1"
 
 class Config:
     def __init__(
@@ -33,7 +46,9 @@ class Config:
             enhance_output: bool,
             id_image: str,
             att_image: str,
-            output_dir: str
+            output_dir: str,
+            max_megapixels: float = 0,
+            restore_full_resolution: bool = False
     ):
         self.face_detector_weights = face_detector_weights
         self.face_id_weights = face_id_weights
@@ -54,6 +69,8 @@ class Config:
         self.id_image = id_image
         self.att_image = att_image
         self.output_dir = output_dir
+        self.max_megapixels = max_megapixels
+        self.restore_full_resolution = restore_full_resolution
 
 
 class Images(BaseModel):
@@ -63,42 +80,27 @@ class Images(BaseModel):
     watermark: str
 
 
-app = FastAPI()
+class TemplateImages(BaseModel):
+    image_1: str
+    templates: List[str]
+    directory: str
+    watermark: str
 
 
-def copy_image_with_uuid(images,new_filename):
-    try:
-        # Get the absolute path of the original image
-        original_path = os.path.abspath(os.path.join(os.getcwd(), '..', 'public', images.directory, images.image_2))
-          
-        # Define the destination path
-        destination_path = os.path.join(os.path.dirname(original_path), new_filename)
-
-        # Copy the file
-        shutil.copy2(original_path, destination_path)
-        
-        return destination_path  # Return the new file path
-    except Exception as e:
-        print(f"Error copying image: {e}")
-        return None
+app = FastAPI()
 
-def load_image_into_numpy_array(data):
-    return np.array()
 
+@app.on_event("startup")
+def report_startup_time():
+    # The networks aren't part of it, they are built on the first request that needs them
+    print(f"Ready in {time.perf_counter() - START_TIME:.2f}s")
 
-@app.post("/")
-async def read_root(images: Images):
-    id_image = os.path.abspath(os.path.join(os.getcwd(), '..', 'public', images.image_1))
-    
-    _, ext = os.path.splitext(images.image_2)
-    new_filename = f"{uuid.uuid4()}{ext}"
+# The model shared by the endpoints, loaded on the first request
+swap_model: Optional[SimSwap] = None
 
-    att_image = copy_image_with_uuid(images, new_filename)
-    sim_output_dir = os.path.abspath(os.path.join(os.getcwd(), '..', 'public'))
 
-    output_dir = os.path.abspath(os.path.join(os.getcwd(), '..', 'public', 'img'))
-    save_path = os.path.abspath(os.path.join(os.getcwd(), '..', 'public'))
-    config = Config(
+def build_config(id_image: str = "", att_image: str = "", output_dir: str = "") -> Config:
+    return Config(
         face_detector_weights="weights/scrfd_10g_bnkps.onnx",
         face_id_weights="weights/arcface_net.jit",
         parsing_model_weights="weights/79999_iter.pth",
@@ -117,34 +119,119 @@ async def read_root(images: Images):
         enhance_output=True,
         id_image=id_image,
         att_image=att_image,
-        output_dir=sim_output_dir
+        output_dir=output_dir,
+        max_megapixels=MAX_MEGAPIXELS,
+        restore_full_resolution=RESTORE_FULL_RESOLUTION
 
     )
+
+
+def get_swap_model() -> SimSwap:
+    global swap_model
+    if swap_model is None:
+        swap_model = SimSwap(config=build_config())
+    return swap_model
+
+
+def prepare_template(template_path: str) -> Tuple[TemplateCache, int, int]:
+    # The template with the white padding below it, its original and padded heights to crop
+    # the result. The padding is added in memory, the file is decoded once
+    att_image, height = pad_height(imread_rgb(template_path))
+
+    return get_swap_model().precompute_template(att_image), height, att_image.shape[0]
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def load_template(template_path: str, mtime: float) -> Tuple[TemplateCache, int, int]:
+    # Detection, alignment and face masks of a template don't depend on the user's image,
+    # so they are computed once per template file version (mtime) and kept in host memory
+    return prepare_template(template_path)
+
+
+def save_result(height: int, padded_height: int, output: np.ndarray, path: str) -> np.ndarray:
+    # Crops the padding off exactly and encodes the result once, returns the cropped result
+    output = remove_height_padding(output, height, padded_height)
+    imwrite_rgb(path, output)
+    return output
+
+def load_image_into_numpy_array(data):
+    return np.array()
+
+
+@app.post("/")
+async def read_root(images: Images):
+    public_dir = os.path.abspath(os.path.join(os.getcwd(), '..', 'public'))
+    img_dir = os.path.join(public_dir, "img")
+    os.makedirs(img_dir, exist_ok=True)
+
+    _, ext = os.path.splitext(images.image_2)
+    new_filename = "swap_{}{}".format(uuid.uuid4(), ext)
+
+    try:
+        # The shared model with the user's identity, run like in run_application (SimSwap.__call__)
+        model = get_swap_model()
+        model.set_id_image(imread_rgb(os.path.join(public_dir, images.image_1)))
+
+        # The padding is added and removed in memory, the input is decoded and the result encoded once
+        # Without the restore, large JPEGs are decoded at a reduced size right away
+        att_path = os.path.join(public_dir, images.directory, images.image_2)
+        decode_megapixels = 0 if model.restore_full_resolution else model.max_megapixels
+        att_image, height = pad_height(imread_rgb_limited(att_path, decode_megapixels))
+        output = remove_height_padding(model(att_image), height, att_image.shape[0])
+        imwrite_rgb(os.path.join(img_dir, new_filename), output)
+
+        if images.watermark == "false":
+            return {
+                "success": "true",
+                "result": "img/{}".format(new_filename)
+            }
+        else:
+            # Watermarked from memory, the saved result isn't decoded again
+            return {
+                "success": "true",
+                "result": save_watermarked(output, new_filename)
+            }
+
+    except Exception as e:
+        return {
+            "success": "false",
+            "message": str(e)
+        }
+
+
+@app.post("/templates")
+async def swap_templates(images: TemplateImages):
+    # One source image against many templates: the id latent is computed once and
+    # the faces of all templates go through the generator together
+    public_dir = os.path.abspath(os.path.join(os.getcwd(), '..', 'public'))
+    img_dir = os.path.join(public_dir, "img")
+    os.makedirs(img_dir, exist_ok=True)
+
     try:
-        height_increaser(att_image)
-        result = run_application(config)
-        if result == True:
-            img_path = (os.path.abspath(os.path.join(os.getcwd(), '..', "public", "img")))
-            height_decrease(img_path + "/swap_{}".format(new_filename))
+        id_image = imread_rgb(os.path.join(public_dir, images.image_1))
+
+        templates = []
+        for template in images.templates:
+            template_path = os.path.join(public_dir, images.directory, template)
+            templates.append(load_template(template_path, os.path.getmtime(template_path)))
+
+        outputs = get_swap_model().swap_templates(id_image, [x[0] for x in templates])
+
+        results = []
+        for name, (_, height, padded_height), output in zip(images.templates, templates, outputs):
+            _, ext = os.path.splitext(name)
+            filename = "swap_{}{}".format(uuid.uuid4(), ext)
+            output = save_result(height, padded_height, output, os.path.join(img_dir, filename))
 
             if images.watermark == "false":
-                return {
-                    "success": "true",
-                    "result": "img/swap_{}".format(new_filename)
-                }
+                results.append("img/{}".format(filename))
             else:
-                result_2 = watermark_adder("swap_{}".format(new_filename), save_path)
-
-                if not result_2:
-                    raise Exception("InternalServerError")
-                else:
-                    return {
-                        "success": "true",
-                        "result": result_2
-                    }
+                results.append(save_watermarked(output, filename))
 
-        else:
-            raise Exception(result)
+        return {
+            "success": "true",
+            "results": results
+        }
 
     except Exception as e:
         return {